@@ -1,20 +1,69 @@
 import json
 import base64
 import traceback
+import uuid
 from urllib.parse import parse_qsl
 
-from util import SLACK_CALLBACK_HANDLERS, validate_signature, extract_key_from_payload
+from util import (
+    DEFERRED_CALLBACKS,
+    MIGRATIONS,
+    SLACK_CALLBACK_HANDLERS,
+    validate_signature,
+    extract_key_from_payload,
+    claim_job,
+    respond,
+    work_queue,
+)
 
 import quotes  # NOQA
 import polls  # NOQA
 
 
+def run_deferred(job):
+    callback_type = job["callback_type"]
+    data = job["data"]
+    if "id" in job and not claim_job(job["id"]):
+        print("already ran job", job["id"], "skipping")
+        return
+    try:
+        response = SLACK_CALLBACK_HANDLERS[callback_type][job["key"]](data)
+    except Exception:
+        print("data that lead to exception:")
+        print(json.dumps(data, indent=4).replace(" ", "_"))
+        traceback.print_exc()
+        response = "Oops, I failed to execute properly:\n" + traceback.format_exc()
+    if callback_type == "command":
+        try:
+            respond(data["response_url"], response)
+        except Exception:
+            # the work is done, failing here would only make Lambda retry it
+            traceback.print_exc()
+
+
+def defer(callback_type, key, data):
+    print("deferring", callback_type, key)
+    # trigger_id is unique per interaction, the same click or command delivered
+    # twice still runs once
+    job_id = data.get("trigger_id") or str(uuid.uuid4())
+    work_queue.put(
+        {"callback_type": callback_type, "key": key, "data": data, "id": job_id}
+    )
+    return {"statusCode": 200}
+
+
 def lambda_handler(event, context):
     data = None
     sub_data = None
     if event.get("source", None) == "aws.events":
         polls.schedule_all_recurring_polls()
         return
+    if "deferred" in event:
+        run_deferred(event["deferred"])
+        return
+    if "migration" in event:
+        # one-off maintenance, run with e.g.
+        # aws lambda invoke --payload '{"migration": "search-index", "team": "T123"}'
+        return MIGRATIONS[event["migration"]](event["team"], **event.get("args", {}))
 
     try:
         validate_signature(event)
@@ -27,6 +76,8 @@ def lambda_handler(event, context):
             command = data["command"]
             if command not in handlers:
                 raise Exception(f"No command hanlder registered for {command}")
+            if ("command", command) in DEFERRED_CALLBACKS:
+                return defer("command", command, data)
 
             response_text = handlers[command](data)
             return {
@@ -50,6 +101,8 @@ def lambda_handler(event, context):
             handlers = SLACK_CALLBACK_HANDLERS[callback_type]
             if key not in handlers:
                 raise Exception(f"No {callback_type} callback registered for {key}")
+            if (callback_type, key) in DEFERRED_CALLBACKS:
+                return defer(callback_type, key, sub_data)
             response = handlers[key](sub_data)
             return {
                 "statusCode": 200,
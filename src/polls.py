@@ -1,12 +1,16 @@
-import arrow
+import hashlib
 import re
-import time
-import random
 import pytz
 import json
+import time
+import traceback
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from dateutil import rrule
 from boto3.dynamodb.conditions import Key, Attr
 from util import (
+    respond,
     slack_command,
     send_message,
     slack_block_action,
@@ -14,13 +18,53 @@ from util import (
     update_message,
     open_view,
     db_table,
+    meta_key,
     update_view,
     DATABASE_INDEX_NAME,
     get_all_scheduled_posts,
+    get_channel_member_count,
     delete_scheduled_message,
+    query_items,
+    put_new_item,
+    batch_get_items,
+    batch_write_items,
+    background_writer,
+    slack_api_stats,
+)
+
+# A hot poll gets at most one chat.update per interval, the lease makes sure
+# only one invocation at a time renders it.
+RENDER_INTERVAL_MS = 500
+RENDER_LEASE_MS = 5000
+
+# Polls with more options than we have number emojis use the large layout
+SMALL_POLL_OPTIONS = 9
+MAX_POLL_OPTIONS = 50
+VOTERS_SHOWN = 100
+LARGE_POLL_VOTERS_SHOWN = 5
+VOTERS_PAGE_SIZE = 100
+SECTION_TEXT_MAX = 3000
+RESULT_OPTION_MAX = 250
+
+# Recurring polls are scheduled per channel on a bounded pool of threads, util
+# paces their Slack calls per API method.
+SCHEDULER_WORKERS = 8
+_scheduler_executor = None
+
+# How far ahead recurring polls are scheduled. The compiled rule of every
+# recurring definition is kept per poll uuid for as long as the Lambda is warm.
+SCHEDULE_HORIZON_DAYS = 10
+WEEKDAYS = (
+    "Monday",
+    "Tuesday",
+    "Wednesday",
+    "Thursday",
+    "Friday",
+    "Saturday",
+    "Sunday",
 )
+_recurrence_rules = {}
 
-# TODO more votes? The amount of number emojis is limited to single digits.
 to_num = {
     0: "zero",
     1: "one",
@@ -35,6 +79,183 @@ to_num = {
 }
 
 
+def _plain_text(text, **kwargs):
+    return {"type": "plain_text", "text": text, **kwargs}
+
+
+def _select_option(text, value):
+    return {"text": _plain_text(text), "value": value}
+
+
+def _with_element(block, **element):
+    # copy-on-write: the templates below are shared between invocations
+    return {**block, "element": {**block["element"], **element}}
+
+
+# The modal templates are built once per container and never mutated, every
+# invocation only copies the few blocks it has to fill in.
+POLL_MODAL_BLOCKS = (
+    {
+        "type": "input",
+        "block_id": "title",
+        "element": {
+            "type": "plain_text_input",
+            "multiline": True,
+            "action_id": "title",
+            "initial_value": "",
+        },
+        "label": _plain_text("What's the poll about", emoji=True),
+        "optional": False,
+    },
+    {
+        "type": "input",
+        "block_id": "channel",
+        "element": {
+            "type": "channels_select",
+            "placeholder": _plain_text("Channel", emoji=True),
+            "action_id": "selected-channel",
+        },
+        "label": _plain_text("Select a channel", emoji=True),
+    },
+    {"type": "divider"},
+    {
+        "type": "input",
+        "block_id": "advanced-options",
+        "element": {
+            "type": "checkboxes",
+            "options": [
+                {
+                    "text": _plain_text("Anonymous voting", emoji=True),
+                    "value": "anonymous-votes",
+                },
+            ],
+            "action_id": "create-poll-options-changed",
+        },
+        "label": _plain_text("Advanced options", emoji=True),
+        "optional": True,
+    },
+    {
+        "type": "section",
+        "block_id": "recurring-settings",
+        "text": _plain_text("Recurring poll"),
+        "accessory": {
+            "type": "static_select",
+            "action_id": "update-recurring-settings",
+            "initial_option": {"value": "never", "text": _plain_text("Never")},
+            "options": [
+                {"value": "never", "text": _plain_text("Never")},
+                {"value": "daily", "text": _plain_text("Daily")},
+                {"value": "weekly", "text": _plain_text("Weekly")},
+                {"value": "monthly", "text": _plain_text("Monthly")},
+            ],
+        },
+    },
+    {
+        "type": "input",
+        "block_id": "limit-votes",
+        "element": {
+            "type": "static_select",
+            "placeholder": _plain_text("Select an item", emoji=True),
+            "options": [
+                _select_option("Unlimited" if i == 0 else str(i), str(i))
+                for i in range(10)
+            ],
+            "action_id": "limit-votes",
+            "initial_option": _select_option("Unlimited", "0"),
+        },
+        "label": _plain_text("Limit the amount of votes", emoji=True),
+    },
+    {"type": "divider"},
+)
+
+POLL_OPTION_BLOCKS = tuple(
+    {
+        "type": "input",
+        "block_id": f"option-{i}",
+        "element": {
+            "type": "plain_text_input",
+            "action_id": "option",
+            "initial_value": "",
+        },
+        "label": _plain_text(f"Option {i + 1}", emoji=True),
+        "optional": True if i >= 2 else False,
+    }
+    for i in range(MAX_POLL_OPTIONS)
+)
+
+ADD_OPTION_BLOCK = {
+    "type": "actions",
+    "block_id": "add-option",
+    "elements": [
+        {
+            "type": "button",
+            "text": _plain_text("Add option"),
+            "value": "add",
+            "action_id": "add-poll-option",
+        }
+    ],
+}
+
+RECURRING_TZ_BLOCK = {
+    "type": "input",
+    "block_id": "recurring-sub-settings-tz",
+    "label": _plain_text("Timezone", emoji=True),
+    "element": {
+        "type": "plain_text_input",
+        "action_id": "timzeone",
+        "initial_value": "Europe/Amsterdam",
+    },
+    "optional": False,
+}
+
+RECURRING_TIME_BLOCK = {
+    "type": "input",
+    "block_id": "recurring-sub-settings-time",
+    "label": _plain_text("Pick a time for posting the poll.", emoji=True),
+    "element": {
+        "type": "timepicker",
+        "action_id": "timepicker",
+        "placeholder": _plain_text("Select a time"),
+    },
+    "optional": False,
+}
+
+RECURRING_DAYS_BLOCK = {
+    "type": "input",
+    "block_id": "recurring-sub-settings-days",
+    "element": {
+        "type": "multi_static_select",
+        "placeholder": _plain_text("Select days", emoji=True),
+        "options": [_select_option(day, day) for day in WEEKDAYS],
+        "action_id": "on-which-days",
+    },
+    "label": _plain_text("Select the days on which to post", emoji=True),
+}
+
+RECURRING_DAY_NUMBER_BLOCK = {
+    "type": "input",
+    "block_id": "recurring-sub-settings-day-number",
+    "element": {
+        "type": "static_select",
+        "placeholder": _plain_text("Select days", emoji=True),
+        "options": [
+            _select_option(
+                str(day) if day < 29 else f"{day} (will not happen every month)",
+                str(day),
+            )
+            for day in range(32)
+        ],
+        "action_id": "on-which-day-number",
+    },
+    "label": _plain_text("Select the day of the month on which to post", emoji=True),
+}
+
+RECURRING_FINAL_DIVIDER = {
+    "type": "divider",
+    "block_id": "recurring-sub-settings-final-divider",
+}
+
+
 @slack_command("/easee-poll")
 def _create_new_poll(data):
     sections = list(
@@ -52,142 +273,16 @@ def _create_new_poll(data):
 
     trigger_id = data["trigger_id"]
     channel_id = data["channel_id"]
-    blocks = [
-        {
-            "type": "input",
-            "block_id": "title",
-            "element": {
-                "type": "plain_text_input",
-                "multiline": True,
-                "action_id": "title",
-                "initial_value": title,
-            },
-            "label": {
-                "type": "plain_text",
-                "text": "What's the poll about",
-                "emoji": True,
-            },
-            "optional": False,
-        },
-        {
-            "type": "input",
-            "block_id": "channel",
-            "element": {
-                "type": "channels_select",
-                "placeholder": {
-                    "type": "plain_text",
-                    "text": "Channel",
-                    "emoji": True,
-                },
-                "action_id": "selected-channel",
-                "initial_channel": channel_id,
-            },
-            "label": {"type": "plain_text", "text": "Select a channel", "emoji": True},
-        },
-        {"type": "divider"},
-        {
-            "type": "input",
-            "block_id": "advanced-options",
-            "element": {
-                "type": "checkboxes",
-                "options": [
-                    {
-                        "text": {
-                            "type": "plain_text",
-                            "text": "Anonymous voting",
-                            "emoji": True,
-                        },
-                        "value": "anonymous-votes",
-                    },
-                ],
-                "action_id": "create-poll-options-changed",
-            },
-            "label": {"type": "plain_text", "text": "Advanced options", "emoji": True},
-            "optional": True,
-        },
-        {
-            "type": "section",
-            "block_id": "recurring-settings",
-            "text": {"type": "plain_text", "text": "Recurring poll"},
-            "accessory": {
-                "type": "static_select",
-                "action_id": "update-recurring-settings",
-                "initial_option": {
-                    "value": "never",
-                    "text": {"type": "plain_text", "text": "Never"},
-                },
-                "options": [
-                    {"value": "never", "text": {"type": "plain_text", "text": "Never"}},
-                    {"value": "daily", "text": {"type": "plain_text", "text": "Daily"}},
-                    {
-                        "value": "weekly",
-                        "text": {"type": "plain_text", "text": "Weekly"},
-                    },
-                    {
-                        "value": "monthly",
-                        "text": {"type": "plain_text", "text": "Monthly"},
-                    },
-                ],
-            },
-        },
-        {
-            "type": "input",
-            "block_id": "limit-votes",
-            "element": {
-                "type": "static_select",
-                "placeholder": {
-                    "type": "plain_text",
-                    "text": "Select an item",
-                    "emoji": True,
-                },
-                "options": [],
-                "action_id": "limit-votes",
-                "initial_option": {
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Unlimited",
-                    },
-                    "value": "0",
-                },
-            },
-            "label": {
-                "type": "plain_text",
-                "text": "Limit the amount of votes",
-                "emoji": True,
-            },
-        },
-        {"type": "divider"},
-    ]
-    for i in range(10):
-        blocks[-2]["element"]["options"].append(
-            {
-                "text": {
-                    "type": "plain_text",
-                    "text": "Unlimited" if i == 0 else str(i),
-                },
-                "value": str(i),
-            }
-        )
-    for i in range(9):
-        blocks.append(
-            {
-                "type": "input",
-                "block_id": f"option-{i}",
-                "element": {
-                    "type": "plain_text_input",
-                    "action_id": "option",
-                    "initial_value": prefilled_options[i]
-                    if i < len(prefilled_options)
-                    else "",
-                },
-                "label": {
-                    "type": "plain_text",
-                    "text": f"Option {i + 1}",
-                    "emoji": True,
-                },
-                "optional": True if i >= 2 else False,
-            }
-        )
+    blocks = list(POLL_MODAL_BLOCKS)
+    blocks[0] = _with_element(blocks[0], initial_value=title)
+    blocks[1] = _with_element(blocks[1], initial_channel=channel_id)
+    option_count = min(max(9, len(prefilled_options) + 1), MAX_POLL_OPTIONS)
+    for i, block in enumerate(POLL_OPTION_BLOCKS[:option_count]):
+        if i < len(prefilled_options):
+            block = _with_element(block, initial_value=prefilled_options[i])
+        blocks.append(block)
+    if option_count < MAX_POLL_OPTIONS:
+        blocks.append(ADD_OPTION_BLOCK)
     open_view(
         trigger_id,
         blocks=blocks,
@@ -198,6 +293,32 @@ def _create_new_poll(data):
     return "Creating poll"
 
 
+@slack_block_action("add-poll-option")
+def _add_poll_option(data):
+    view = data["view"]
+    option_count = len(
+        [block for block in view["blocks"] if block["block_id"].startswith("option-")]
+    )
+    for at, block in enumerate(view["blocks"]):
+        if block["block_id"] == "add-option":
+            break
+    view["blocks"].insert(at, POLL_OPTION_BLOCKS[option_count])
+    if option_count + 1 >= MAX_POLL_OPTIONS:
+        del view["blocks"][at + 1]
+
+    update_view(
+        {
+            "blocks": view["blocks"],
+            "title": view["title"],
+            "submit": view["submit"],
+            "callback_id": view["callback_id"],
+            "type": view["type"],
+        },
+        view_id=view["id"],
+    )
+    return ""
+
+
 @slack_block_action("update-recurring-settings")
 def _update_recurring_settings(data):
     view = data["view"]
@@ -217,131 +338,18 @@ def _update_recurring_settings(data):
         "update-recurring-settings"
     ]["selected_option"]["value"]
 
-    at = recurring_block + 1
+    new_blocks = []
     if frequency != "never":
-        view["blocks"].insert(
-            at,
-            {
-                "type": "input",
-                "block_id": "recurring-sub-settings-tz",
-                "label": {
-                    "type": "plain_text",
-                    "text": "Timezone",
-                    "emoji": True,
-                },
-                "element": {
-                    "type": "plain_text_input",
-                    "action_id": "timzeone",
-                    "initial_value": "Europe/Amsterdam",
-                },
-                "optional": False,
-            },
-        )
-        at += 1
-        view["blocks"].insert(
-            at,
-            {
-                "type": "input",
-                "block_id": "recurring-sub-settings-time",
-                "label": {
-                    "type": "plain_text",
-                    "text": "Pick a time for posting the poll.",
-                    "emoji": True,
-                },
-                "element": {
-                    "type": "timepicker",
-                    "action_id": "timepicker",
-                    "placeholder": {"type": "plain_text", "text": "Select a time"},
-                },
-                "optional": False,
-            },
-        )
-        at += 1
-
+        new_blocks += [RECURRING_TZ_BLOCK, RECURRING_TIME_BLOCK]
     if frequency == "weekly":
-        view["blocks"].insert(
-            at,
-            {
-                "type": "input",
-                "block_id": "recurring-sub-settings-days",
-                "element": {
-                    "type": "multi_static_select",
-                    "placeholder": {
-                        "type": "plain_text",
-                        "text": "Select days",
-                        "emoji": True,
-                    },
-                    "options": [],
-                    "action_id": "on-which-days",
-                },
-                "label": {
-                    "type": "plain_text",
-                    "text": "Select the days on which to post",
-                    "emoji": True,
-                },
-            },
-        )
-        for day in (
-            "Monday",
-            "Tuesday",
-            "Wednesday",
-            "Thursday",
-            "Friday",
-            "Saturday",
-            "Sunday",
-        ):
-            view["blocks"][at]["element"]["options"].append(
-                {
-                    "text": {
-                        "type": "plain_text",
-                        "text": day,
-                    },
-                    "value": day,
-                }
-            )
-        at += 1
+        new_blocks.append(RECURRING_DAYS_BLOCK)
     elif frequency == "monthly":
-        view["blocks"].insert(
-            at,
-            {
-                "type": "input",
-                "block_id": "recurring-sub-settings-day-number",
-                "element": {
-                    "type": "static_select",
-                    "placeholder": {
-                        "type": "plain_text",
-                        "text": "Select days",
-                        "emoji": True,
-                    },
-                    "options": [],
-                    "action_id": "on-which-day-number",
-                },
-                "label": {
-                    "type": "plain_text",
-                    "text": "Select the day of the month on which to post",
-                    "emoji": True,
-                },
-            },
-        )
-        for day in range(32):
-            view["blocks"][at]["element"]["options"].append(
-                {
-                    "text": {
-                        "type": "plain_text",
-                        "text": str(day)
-                        if day < 29
-                        else f"{day} (will not happen every month)",
-                    },
-                    "value": str(day),
-                }
-            )
-        at += 1
-
+        new_blocks.append(RECURRING_DAY_NUMBER_BLOCK)
     if frequency != "never":
-        view["blocks"].insert(
-            at, {"type": "divider", "block_id": "recurring-sub-settings-final-divider"}
-        )
-        at += 1
+        new_blocks.append(RECURRING_FINAL_DIVIDER)
+
+    at = recurring_block + 1
+    view["blocks"][at:at] = new_blocks
 
     update_view(
         {
@@ -356,141 +364,877 @@ def _update_recurring_settings(data):
     return ""
 
 
-@slack_block_action("vote-poll")
-def _handle_vote(data):
-    blocks = data["message"]["blocks"]
-    added_or_removed_user = f'<@{data["user"]["id"]}>'
+def _voters_attribute(option):
+    return f"voters:{option}"
+
+
+def _get_voters(item, option):
+    return item.get(_voters_attribute(option), set())
 
-    item = db_table.get_item(
-        Key={
-            "timestamp": int(data["message"]["blocks"][0]["block_id"].split(":")[1]),
+
+def _parse_legacy_message(blocks):
+    # Only used once per old poll, to recover what newer polls store directly
+    title = re.sub(" - max \\d+ votes per person$", "", blocks[0]["text"]["text"])
+    title = re.sub(" - \\(anonymous\\)$", "", title)
+    options = [
+        re.sub("^:\\w+: ", "", re.sub(" `\\d+`$", "", block["text"]["text"]))
+        for block in blocks
+        if re.match("^option-\\d+$", block.get("block_id", ""))
+    ]
+    scheduled = "scheduled regularly" in json.dumps(blocks[-1])
+    return title, options, scheduled
+
+
+def _upgrade_poll(item, blocks):
+    # Older polls keep their voters in the "votes" lists and lack the counters
+    # and texts, add them once. The condition on render_requested makes sure no
+    # vote came in since we read the item.
+    names = {"#votes": "votes", "#counts": "counts", "#tallies": "tallies"}
+    values = {":votes": {option: [] for option in item["votes"]}}
+    updates = ["#votes = :votes", "#counts = :counts", "#tallies = :tallies"]
+    counts = {}
+    tallies = {}
+    for idx, option in enumerate(item["votes"]):
+        if "tallies" in item:
+            voters = _get_voters(item, option)
+        else:
+            voters = set(item["votes"][option])
+            if len(voters) > 0:
+                names[f"#voters{idx}"] = _voters_attribute(option)
+                values[f":voters{idx}"] = voters
+                updates.append(f"#voters{idx} = :voters{idx}")
+        counts[option] = len(voters)
+        for voter in voters:
+            tallies[voter] = tallies.get(voter, 0) + 1
+    values[":counts"] = counts
+    values[":tallies"] = tallies
+    if "options" not in item:
+        title, options, scheduled = _parse_legacy_message(blocks)
+        names.update({"#title": "title", "#options": "options", "#sch": "scheduled"})
+        values.update({":title": title, ":options": options, ":sch": scheduled})
+        updates += ["#title = :title", "#options = :options", "#sch = :sch"]
+    names["#requested"] = "render_requested"
+    if "render_requested" in item:
+        condition = "#requested = :requested"
+        values[":requested"] = item["render_requested"]
+    else:
+        condition = "attribute_not_exists(#requested)"
+    try:
+        db_table.update_item(
+            Key={"timestamp": item["timestamp"]},
+            UpdateExpression="SET " + ", ".join(updates),
+            ConditionExpression=f"attribute_not_exists(#counts) AND {condition}",
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+        )
+    except db_table.meta.client.exceptions.ConditionalCheckFailedException:
+        # someone else upgraded it or voted in between, the caller re-reads
+        pass
+
+
+def _toggle_vote(item, option, user):
+    # The vote is applied by DynamoDB itself. The condition only fails when a
+    # concurrent click changed this user's votes, then we re-read and retry.
+    limit_votes = item.get("limit_votes", 0)
+    for _ in range(5):
+        names = {
+            "#voters": _voters_attribute(option),
+            "#tallies": "tallies",
+            "#user": user,
+            "#counts": "counts",
+            "#option": option,
+            "#requested": "render_requested",
         }
-    )["Item"]
+        values = {":user": {user}, ":name": user, ":one": 1}
+        if user in _get_voters(item, option):
+            update = (
+                "DELETE #voters :user ADD #requested :one "
+                "SET #tallies.#user = #tallies.#user - :one, "
+                "#counts.#option = #counts.#option - :one"
+            )
+            condition = "contains(#voters, :name)"
+        else:
+            if limit_votes > 0 and item["tallies"].get(user, 0) >= limit_votes:
+                raise Exception("User is at max votes. Can we show this friendly?")
+            update = (
+                "ADD #voters :user, #requested :one "
+                "SET #tallies.#user = if_not_exists(#tallies.#user, :zero) + :one, "
+                "#counts.#option = if_not_exists(#counts.#option, :zero) + :one"
+            )
+            condition = "NOT contains(#voters, :name)"
+            values[":zero"] = 0
+            condition += " AND attribute_not_exists(#closed)"
+            names["#closed"] = "closed"
+            if limit_votes > 0:
+                condition += (
+                    " AND (attribute_not_exists(#tallies.#user)"
+                    " OR #tallies.#user < :limit)"
+                )
+                values[":limit"] = limit_votes
+        try:
+            return db_table.update_item(
+                Key={"timestamp": item["timestamp"]},
+                UpdateExpression=update,
+                ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                ReturnValues="ALL_NEW",
+            )["Attributes"]
+        except db_table.meta.client.exceptions.ConditionalCheckFailedException:
+            item = db_table.get_item(
+                Key={"timestamp": item["timestamp"]}, ConsistentRead=True
+            )["Item"]
+            if item.get("closed", False):
+                raise Exception("This poll is closed")
+    raise Exception("Could not record the vote, too many people are voting at once")
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def _acquire_render_lease(key):
+    now = _now_ms()
+    try:
+        db_table.update_item(
+            Key=key,
+            UpdateExpression="SET #lease = :until",
+            ConditionExpression="attribute_not_exists(#lease) OR #lease < :now",
+            ExpressionAttributeNames={"#lease": "render_lease"},
+            ExpressionAttributeValues={":until": now + RENDER_LEASE_MS, ":now": now},
+        )
+        return True
+    except db_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def _coalesced_render(key, render):
+    # Every vote bumps render_requested. Whoever holds the lease renders the
+    # latest state and records which request it covered, votes that arrive
+    # in the meantime are picked up by the next round instead of their own
+    # chat.update. render returns a digest per block of what is now shown.
+    while _acquire_render_lease(key):
+        item = db_table.get_item(Key=key, ConsistentRead=True)["Item"]
+        wait = int(item.get("rendered_at", 0)) + RENDER_INTERVAL_MS - _now_ms()
+        if wait > 0:
+            time.sleep(wait / 1000)
+            item = db_table.get_item(Key=key, ConsistentRead=True)["Item"]
+        digests = render(item)
+        item = db_table.update_item(
+            Key=key,
+            UpdateExpression=(
+                "SET #rendered = :rendered, #rendered_at = :now, #digests = :digests "
+                "REMOVE #lease"
+            ),
+            ExpressionAttributeNames={
+                "#rendered": "rendered_version",
+                "#rendered_at": "rendered_at",
+                "#digests": "rendered_blocks",
+                "#lease": "render_lease",
+            },
+            ExpressionAttributeValues={
+                ":rendered": item.get("render_requested", 0),
+                ":now": _now_ms(),
+                ":digests": digests,
+            },
+            ReturnValues="ALL_NEW",
+        )["Attributes"]
+        if item.get("render_requested", 0) <= item["rendered_version"]:
+            return
+
+
+def _render_vote_blocks(blocks, item):
+    if item.get("closed", False):
+        return get_blocks_for_closed_poll(item, top_id=blocks[0]["block_id"])
+    anonymous = item["anonymous"]
+    voters = {}
+    if not anonymous:
+        voters = {option: _get_voters(item, option) for option in item["votes"]}
+    return get_blocks_for_polls(
+        title=item["title"],
+        anonymous=anonymous,
+        limit_votes=item.get("limit_votes", 0),
+        texts=item["options"],
+        created_by=item["created_by"],
+        scheduled=item.get("scheduled", False),
+        top_id=blocks[0]["block_id"],
+        voters=voters,
+        counts=item["counts"],
+    )[0]
+
+
+def _block_digests(blocks):
+    return {
+        block.get("block_id") or f"#{idx}": hashlib.sha1(
+            json.dumps(block, sort_keys=True).encode()
+        ).hexdigest()[:16]
+        for idx, block in enumerate(blocks)
+    }
+
+
+def _update_poll_message(item, blocks, channel_id, ts_id):
+    # The renderer owns the message, so comparing digests of its blocks with
+    # the ones we last sent tells us whether chat.update is needed at all.
+    new_blocks = _render_vote_blocks(blocks, item)
+    digests = _block_digests(new_blocks)
+    previous = item.get("rendered_blocks", {})
+    changed = [
+        block_id
+        for block_id, digest in digests.items()
+        if previous.get(block_id) != digest
+    ]
+    if len(changed) == 0 and len(previous) == len(digests):
+        print("poll message is up to date, not updating")
+    else:
+        print("changed poll blocks", changed)
+        update_message(new_blocks, channel_id, ts_id)
+    return digests
+
+
+def _load_poll(data):
+    blocks = data["message"]["blocks"]
+    key = {"timestamp": int(blocks[0]["block_id"].split(":")[1])}
+
+    item = db_table.get_item(Key=key)["Item"]
 
     if item["team"] != f'{data["message"]["team"]}:poll':
         raise Exception("wrong team")
 
-    limit_votes = item.get("limit_votes", 0)
+    for _ in range(5):
+        if "counts" in item:
+            return key, item
+        _upgrade_poll(item, blocks)
+        item = db_table.get_item(Key=key, ConsistentRead=True)["Item"]
+    raise Exception("Could not upgrade this poll, please try again")
 
-    anonymous = item["anonymous"]
 
-    votes = item["votes"]
+@slack_block_action("vote-poll", deferred=True)
+def _handle_vote(data):
+    blocks = data["message"]["blocks"]
+    added_or_removed_user = f'<@{data["user"]["id"]}>'
+    key, item = _load_poll(data)
 
-    current_vote_count_for_user = 0
-    for v in votes.values():
-        if added_or_removed_user in v:
-            current_vote_count_for_user += 1
+    if item.get("closed", False):
+        raise Exception("This poll is closed")
 
     for action in data["actions"]:
-        vote = votes[action["block_id"]]
-        if added_or_removed_user in vote:
-            vote.remove(added_or_removed_user)
+        if action["type"] == "static_select":
+            option = action["selected_option"]["value"]
         else:
-            if limit_votes > 0 and current_vote_count_for_user >= limit_votes:
-                raise Exception("User is at max votes. Can we show this friendly?")
-            vote.append(added_or_removed_user)
+            option = action["block_id"]
+        item = _toggle_vote(item, option, added_or_removed_user)
+
+    _coalesced_render(
+        key,
+        lambda latest: _update_poll_message(
+            latest, blocks, data["channel"]["id"], data["message"]["ts"]
+        ),
+    )
 
-    db_table.put_item(Item=item)
 
-    for block in blocks:
-        if not block["block_id"].startswith("option-"):
+def _voters_page_blocks(poll_id, item, page):
+    # One page of the voters of every option, for polls too big to list them
+    # all in the message
+    blocks = []
+    pages = 1
+    for idx, option in enumerate(item["options"], start=1):
+        voters = sorted(_get_voters(item, f"option-{idx}"))
+        if len(voters) == 0:
             continue
-        vote = votes[block["block_id"].replace("-people", "")]
-        if block["block_id"].endswith("-people"):
-            if not anonymous:
-                block["text"]["text"] = " ".join(vote) + " "
-            else:
-                block["text"]["text"] = ":thumbsup:" * len(vote) + " "
+        pages = max(pages, -(-len(voters) // VOTERS_PAGE_SIZE))
+        text = f"*{idx}. {option[:RESULT_OPTION_MAX]}* `{len(voters)}`"
+        shown = voters[page * VOTERS_PAGE_SIZE : (page + 1) * VOTERS_PAGE_SIZE]
+        if len(shown) > 0:
+            text += "\n" + " ".join(shown)
+        blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": text}})
+    if len(blocks) == 0:
+        blocks.append({"type": "section", "text": _plain_text("Nobody voted yet")})
+
+    pager = []
+    if page > 0:
+        pager.append(
+            {
+                "type": "button",
+                "text": _plain_text("Previous"),
+                "value": f"{poll_id}:{page - 1}",
+                "action_id": "voters-page",
+            }
+        )
+    if page + 1 < pages:
+        pager.append(
+            {
+                "type": "button",
+                "text": _plain_text("Next"),
+                "value": f"{poll_id}:{page + 1}",
+                "action_id": "voters-page",
+            }
+        )
+    if len(pager) > 0:
+        blocks.append({"type": "actions", "elements": pager})
+    blocks.append(
+        {
+            "type": "context",
+            "elements": [_plain_text(f"Page {page + 1} of {pages}")],
+        }
+    )
+    return blocks
+
+
+@slack_block_action("show-voters")
+def _show_voters(data):
+    key, item = _load_poll(data)
+    if item["anonymous"]:
+        raise Exception("The voters of an anonymous poll are secret")
+    open_view(
+        data["trigger_id"],
+        blocks=_voters_page_blocks(key["timestamp"], item, 0),
+        text="Voters",
+        submit_text=None,
+        callback_id="poll-voters",
+    )
+    return ""
+
+
+@slack_block_action("voters-page")
+def _page_voters(data):
+    poll_id, page = map(int, data["actions"][0]["value"].split(":"))
+    item = db_table.get_item(Key={"timestamp": poll_id})["Item"]
+    if item["team"] != f'{data["team"]["id"]}:poll':
+        raise Exception("wrong team")
+    view = data["view"]
+    update_view(
+        {
+            "blocks": _voters_page_blocks(poll_id, item, page),
+            "title": view["title"],
+            "callback_id": view["callback_id"],
+            "type": view["type"],
+        },
+        view_id=view["id"],
+    )
+    return ""
+
+
+def _summarize_poll(item, channel_member_count):
+    counts = {option: int(count) for option, count in item["counts"].items()}
+    total_votes = sum(counts.values())
+    voters = len([user for user, votes in item["tallies"].items() if votes > 0])
+    ranking = []
+    for idx, text in enumerate(item["options"], start=1):
+        votes = counts.get(f"option-{idx}", 0)
+        ranking.append(
+            {
+                "text": text,
+                "votes": votes,
+                "percentage": round(100 * votes / total_votes) if total_votes else 0,
+            }
+        )
+    ranking.sort(key=lambda x: x["votes"], reverse=True)
+    rank = 0
+    for position, entry in enumerate(ranking, start=1):
+        if position == 1 or entry["votes"] < ranking[position - 2]["votes"]:
+            rank = position
+        entry["rank"] = rank
+    return {
+        "total_votes": total_votes,
+        "voters": voters,
+        "channel_members": channel_member_count,
+        "turnout": round(100 * voters / channel_member_count)
+        if channel_member_count
+        else 0,
+        "ranking": ranking,
+    }
+
+
+@slack_block_action("close-poll", deferred=True)
+def _handle_close_poll(data):
+    user = data["user"]["id"]
+    key, item = _load_poll(data)
+    if item.get("closed", False):
+        return
+    if item["created_by"] != user:
+        respond(
+            data["response_url"],
+            "Only the creator of the poll can close it",
+            ephemeral=True,
+        )
+        return
+
+    # The summary is computed once, closed polls are rendered from it only.
+    # Votes that land in between change render_requested, then the summary is
+    # computed again from a fresh read.
+    channel_member_count = get_channel_member_count(data["channel"]["id"])
+    for _ in range(5):
+        summary = _summarize_poll(item, channel_member_count)
+        values = {":true": True, ":summary": summary, ":user": user, ":one": 1}
+        if "render_requested" in item:
+            unchanged = "#requested = :requested"
+            values[":requested"] = item["render_requested"]
         else:
-            block["text"]["text"] = re.sub(" `\\d+`$", "", block["text"]["text"]) + (
-                f" `{len(vote)}`" if len(vote) > 0 else ""
+            unchanged = "attribute_not_exists(#requested)"
+        try:
+            db_table.update_item(
+                Key=key,
+                UpdateExpression=(
+                    "SET #closed = :true, #summary = :summary, #closed_by = :user "
+                    "ADD #requested :one"
+                ),
+                ConditionExpression=f"attribute_not_exists(#closed) AND {unchanged}",
+                ExpressionAttributeNames={
+                    "#closed": "closed",
+                    "#summary": "summary",
+                    "#closed_by": "closed_by",
+                    "#requested": "render_requested",
+                },
+                ExpressionAttributeValues=values,
             )
-    update_message(blocks, data["channel"]["id"], data["message"]["ts"])
+            break
+        except db_table.meta.client.exceptions.ConditionalCheckFailedException:
+            item = db_table.get_item(Key=key, ConsistentRead=True)["Item"]
+            if item.get("closed", False):
+                return
+    else:
+        respond(
+            data["response_url"],
+            "Could not close the poll, too many people are voting. Please try again.",
+            ephemeral=True,
+        )
+        return
+
+    blocks = data["message"]["blocks"]
+    _coalesced_render(
+        key,
+        lambda latest: _update_poll_message(
+            latest, blocks, data["channel"]["id"], data["message"]["ts"]
+        ),
+    )
+
+
+def _results_sections(lines):
+    # Section text is capped at 3000 characters, the option texts in the lines
+    # are shortened so even 50 long options fit in a handful of sections.
+    sections = []
+    text = None
+    for line in lines:
+        if text is not None and len(text) + 1 + len(line) <= SECTION_TEXT_MAX:
+            text += "\n" + line
+            continue
+        if text is not None:
+            sections.append(text)
+        text = line
+    if text is not None:
+        sections.append(text)
+    return [
+        {
+            "type": "section",
+            "block_id": f"results-{idx}",
+            "text": {"type": "mrkdwn", "text": text},
+        }
+        for idx, text in enumerate(sections)
+    ]
+
+
+def get_blocks_for_closed_poll(item, top_id):
+    summary = item["summary"]
+    lines = []
+    for entry in summary["ranking"]:
+        text = entry["text"]
+        if len(text) > RESULT_OPTION_MAX:
+            text = text[: RESULT_OPTION_MAX - 1] + "…"
+        lines.append(
+            f"{entry['rank']}. *{text}* - {entry['votes']} votes ({entry['percentage']}%)"
+        )
+    return [
+        {
+            "type": "section",
+            "block_id": top_id,
+            "text": _plain_text(f"{item['title']} - closed"),
+        },
+        *_results_sections(lines),
+        {
+            "type": "context",
+            "elements": [
+                {
+                    "type": "mrkdwn",
+                    "text": f"{summary['voters']} of {summary['channel_members']} channel members voted ({summary['turnout']}%), "
+                    f"poll created by <@{item['created_by']}>, closed by <@{item['closed_by']}>",
+                }
+            ],
+        },
+    ]
 
 
 def get_message_id(msg):
-    # strip off the last 3 random digits
+    # strip off the last 3 digits, the per-poll offset _occurrence_key adds
+    # to the occurrence
     return msg["blocks"][0]["block_id"][:-3]
 
 
-def get_next_event_timestamps(recurring_data):
-    tz = recurring_data["tz"]
-    frequency = recurring_data["frequency"]
+def _compile_recurrence(recurring_data):
+    tz = pytz.timezone(recurring_data["tz"])
     hours, minutes = map(int, recurring_data["time"].split(":"))
+    # The rule works on naive local times, pytz adds the right offset per
+    # occurrence so the poll stays at the same wall clock time across DST.
+    kwargs = {
+        "dtstart": datetime.now(tz).replace(
+            tzinfo=None, hour=0, minute=0, second=0, microsecond=0
+        ),
+        "byhour": hours,
+        "byminute": minutes,
+        "bysecond": 0,
+        "cache": False,
+    }
+    frequency = recurring_data["frequency"]
+    if frequency == "daily":
+        return tz, rrule.rrule(rrule.DAILY, **kwargs)
+    elif frequency == "weekly":
+        days = [WEEKDAYS.index(day) for day in recurring_data.get("days", [])]
+        if len(days) > 0:
+            return tz, rrule.rrule(rrule.WEEKLY, byweekday=days, **kwargs)
+    elif frequency == "monthly":
+        day_number = int(recurring_data.get("day_number", 0))
+        if day_number > 0:
+            return tz, rrule.rrule(rrule.MONTHLY, bymonthday=day_number, **kwargs)
+    return tz, None
 
-    t1 = arrow.now(tz)
-    t = t1.replace(hour=hours, minute=minutes, second=0, microsecond=0)
-    if t < t1:
-        t = t.shift(days=1)
-    for i in range(10):
-        week_day = t.format("dddd")
-        result = int(t.timestamp())
-        if recurring_data["frequency"] == "daily":
-            yield result
-        elif (
-            recurring_data["frequency"] == "weekly"
-            and week_day in recurring_data["days"]
-        ):
-            yield result
-        elif recurring_data["frequency"] == "monthly" and t.day == int(
-            recurring_data["day_number"]
-        ):
+
+def _recurrence_rule(poll_uuid, recurring_data):
+    cached = _recurrence_rules.get(poll_uuid)
+    if cached is None or cached[0] != recurring_data:
+        cached = (recurring_data, _compile_recurrence(recurring_data))
+        _recurrence_rules[poll_uuid] = cached
+    return cached[1]
+
+
+def get_next_event_timestamps(poll_uuid, recurring_data, after, until):
+    # Occurrences as unix timestamps, after < occurrence <= until
+    tz, rule = _recurrence_rule(poll_uuid, recurring_data)
+    if rule is None:
+        return
+    start = datetime.fromtimestamp(after, tz).replace(tzinfo=None)
+    end = datetime.fromtimestamp(until, tz).replace(tzinfo=None)
+    for t in rule.between(start, end, inc=True):
+        result = int(tz.localize(t).timestamp())
+        if after < result <= until:
             yield result
-        t = t.shift(days=1)
 
 
-def schedule_recurring_polls(team):
-    channel_messages = {}
-    all_recurring_polls = db_table.query(
+def _planner_key(team):
+    return {"timestamp": meta_key(team, "recurring-polls")}
+
+
+def _recurring_polls_by_channel(team):
+    # Also returns the polls that were scheduled before but have since been
+    # removed, the planner item remembers their channel until they are cleaned up.
+    polls_by_channel = {}
+    all_recurring_polls = query_items(
         IndexName=DATABASE_INDEX_NAME,
         KeyConditionExpression=Key("team").eq(f"{team}:poll-recurring"),
         ScanIndexForward=False,
     )
-    for recurring_poll in all_recurring_polls["Items"]:
-        print("recurring_poll", recurring_poll)
-        channel = recurring_poll["channel"]
-        if channel not in channel_messages:
-            channel_messages[channel] = {}
-            for scheduled_post in get_all_scheduled_posts(channel):
-                msg_id = get_message_id(scheduled_post)
-                channel_messages[channel][msg_id] = scheduled_post
-
-        scheduled_messages = channel_messages[channel]
-
-        for i in get_next_event_timestamps(recurring_poll["recurring"]):
-            in_msg_id = i * 1000 + random.randint(0, 1000)
-            to_schedule_message_id = f"{recurring_poll['uuid']}:{in_msg_id}"
-            if to_schedule_message_id in scheduled_messages:
-                del scheduled_messages[to_schedule_message_id]
-            else:
-                blocks, votes = get_blocks_for_polls(
-                    title=recurring_poll.get("title", "SORRY"),
-                    anonymous=recurring_poll["anonymous"],
-                    limit_votes=recurring_poll["limit_votes"],
-                    texts=recurring_poll["options"],
-                    created_by=recurring_poll["created_by"],
-                    scheduled=True,
-                    top_id=to_schedule_message_id,
-                )
-                msg_id = send_message(
-                    channel, blocks=blocks, text="Recurring poll", post_at=i
-                )
-                db_table.put_item(
-                    Item={
-                        "team": f"{team}:poll",
-                        "timestamp": in_msg_id,
-                        "created_by": recurring_poll["created_by"],
-                        "anonymous": recurring_poll["anonymous"],
-                        "votes": votes,
-                        "limit_votes": recurring_poll["limit_votes"],
-                        "scheduled_message_id": msg_id,
-                    }
+    for recurring_poll in all_recurring_polls:
+        polls_by_channel.setdefault(recurring_poll["channel"], []).append(
+            recurring_poll
+        )
+
+    current = {
+        recurring_poll["uuid"]: channel
+        for channel, recurring_polls in polls_by_channel.items()
+        for recurring_poll in recurring_polls
+    }
+    planner = db_table.get_item(Key=_planner_key(team)).get("Item", {})
+    known = planner.get("polls", {})
+    removed = {k: v for k, v in known.items() if k not in current}
+    if known != {**current, **removed}:
+        db_table.update_item(
+            Key=_planner_key(team),
+            UpdateExpression="SET #team = :team, #polls = :polls",
+            ExpressionAttributeNames={"#team": "team", "#polls": "polls"},
+            ExpressionAttributeValues={
+                ":team": f"{team}:meta",
+                ":polls": {**current, **removed},
+            },
+        )
+    return polls_by_channel, removed
+
+
+def _poll_fingerprint(recurring_poll):
+    # Changes whenever the poll is edited in a way that changes its messages
+    settings = [
+        recurring_poll["recurring"],
+        recurring_poll["channel"],
+        recurring_poll.get("title", "SORRY"),
+        recurring_poll["options"],
+        recurring_poll["anonymous"],
+        recurring_poll["limit_votes"],
+    ]
+    return hashlib.sha256(
+        json.dumps(settings, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def _occurrence_key(poll_uuid, occurrence):
+    # The same occurrence always maps to the same key, so a tick that is retried
+    # finds the instance it created before instead of posting the poll twice.
+    # get_message_id strips the offset again.
+    offset = int(hashlib.sha256(poll_uuid.encode()).hexdigest()[:8], 16) % 1000
+    return occurrence * 1000 + offset
+
+
+def _probe_occurrence_key(key, occurrence_id):
+    # Another poll hashed to the same key. Try the next offsets and wrap around,
+    # the key must stay in the window of its occurrence for get_message_id.
+    window = key - key % 1000
+    for step in range(1, 1000):
+        candidate = window + (key + step) % 1000
+        found = db_table.get_item(
+            Key={"timestamp": candidate}, ConsistentRead=True
+        ).get("Item")
+        if found is None or found.get("occurrence") == occurrence_id:
+            return candidate, found
+    raise Exception(f"Could not find a free key for occurrence {occurrence_id}")
+
+
+def _plan_recurring_poll(recurring_poll, now, until, legacy_posts):
+    # Every poll keeps a watermark of how far ahead it has been scheduled, so a
+    # tick only schedules the part of the horizon that is new since the last one.
+    poll_uuid = recurring_poll["uuid"]
+    fingerprint = _poll_fingerprint(recurring_poll)
+    scheduled = {
+        int(k): v for k, v in recurring_poll.get("scheduled_messages", {}).items()
+    }
+    after = max(now, int(recurring_poll.get("scheduled_through", 0)))
+
+    if "scheduled_fingerprint" in recurring_poll and (
+        recurring_poll["scheduled_fingerprint"] != fingerprint
+    ):
+        print("recurring poll", poll_uuid, "was edited, rescheduling")
+        for occurrence, msg_id in scheduled.items():
+            if occurrence > now:
+                delete_scheduled_message(recurring_poll["scheduled_channel"], msg_id)
+        scheduled = {}
+        after = now
+
+    occurrences = list(
+        get_next_event_timestamps(poll_uuid, recurring_poll["recurring"], after, until)
+    )
+    if "scheduled_through" not in recurring_poll:
+        # Scheduled before the planner existed, adopt what Slack already has
+        for occurrence in occurrences:
+            msg_id = legacy_posts.pop(f"{poll_uuid}:{occurrence}", None)
+            if msg_id is not None:
+                scheduled[occurrence] = msg_id
+    if legacy_posts is not None:
+        for occurrence in scheduled:
+            legacy_posts.pop(f"{poll_uuid}:{occurrence}", None)
+
+    return {
+        "poll": recurring_poll,
+        "fingerprint": fingerprint,
+        "scheduled": scheduled,
+        "pending": [o for o in occurrences if o not in scheduled],
+        "changed": recurring_poll.get("scheduled_fingerprint") != fingerprint,
+    }
+
+
+def _schedule_pending(team, plans):
+    # The instances are claimed with one batch write, then written again with
+    # their scheduled message id from a background writer while Slack is called.
+    pending = [(plan, occurrence) for plan in plans for occurrence in plan["pending"]]
+    if len(pending) == 0:
+        return
+    keys = {
+        _occurrence_key(plan["poll"]["uuid"], occurrence)
+        for plan, occurrence in pending
+    }
+    existing = {
+        item["timestamp"]: item
+        for item in batch_get_items({"timestamp": key} for key in keys)
+    }
+
+    to_send = []
+    claims = []
+    for plan in plans:
+        recurring_poll = plan["poll"]
+        if len(plan["pending"]) == 0:
+            continue
+        blocks, votes = get_blocks_for_polls(
+            title=recurring_poll.get("title", "SORRY"),
+            anonymous=recurring_poll["anonymous"],
+            limit_votes=recurring_poll["limit_votes"],
+            texts=recurring_poll["options"],
+            created_by=recurring_poll["created_by"],
+            scheduled=True,
+            top_id=None,
+        )
+        for occurrence in plan["pending"]:
+            occurrence_id = f"{recurring_poll['uuid']}:{occurrence}"
+            item = {
+                "timestamp": _occurrence_key(recurring_poll["uuid"], occurrence),
+                "team": f"{team}:poll",
+                "created_by": recurring_poll["created_by"],
+                "anonymous": recurring_poll["anonymous"],
+                "votes": votes,
+                "tallies": {},
+                "counts": {},
+                "limit_votes": recurring_poll["limit_votes"],
+                "title": recurring_poll.get("title", "SORRY"),
+                "options": recurring_poll["options"],
+                "scheduled": True,
+                "occurrence": occurrence_id,
+                "fingerprint": plan["fingerprint"],
+            }
+            found = existing.get(item["timestamp"])
+            if found is not None and found.get("occurrence") != occurrence_id:
+                item["timestamp"], found = _probe_occurrence_key(
+                    item["timestamp"], occurrence_id
                 )
+            if found is None:
+                claims.append(item)
+            elif found.get("fingerprint") != plan["fingerprint"]:
+                # made for settings that have been edited since, never posted
+                claims.append(item)
+            elif "scheduled_message_id" in found:
+                # posted by a tick that did not get to save its watermark
+                plan["scheduled"][occurrence] = found["scheduled_message_id"]
+                continue
+            to_send.append((plan, occurrence, item, blocks))
 
-    print("deleting scheduled messages")
-    for scheduled_messages in channel_messages.values():
-        for k, v in scheduled_messages.items():
-            delete_scheduled_message(channel, v["id"])
+    batch_write_items(claims)
+
+    errors = []
+    try:
+        for plan, occurrence, item, blocks in to_send:
+            first_block = {
+                **blocks[0],
+                "block_id": f"{plan['poll']['uuid']}:{item['timestamp']}",
+            }
+            msg_id = send_message(
+                plan["poll"]["channel"],
+                blocks=[first_block] + blocks[1:],
+                text="Recurring poll",
+                post_at=occurrence,
+            )
+            plan["scheduled"][occurrence] = msg_id
+            background_writer.put({**item, "scheduled_message_id": msg_id}, errors)
+    finally:
+        background_writer.flush()
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def _save_plan(plan, now, until):
+    recurring_poll = plan["poll"]
+    try:
+        db_table.update_item(
+            Key={"timestamp": recurring_poll["timestamp"]},
+            UpdateExpression="SET scheduled_through = :until, "
+            "scheduled_fingerprint = :fingerprint, "
+            "scheduled_channel = :channel, scheduled_messages = :scheduled",
+            ConditionExpression="attribute_exists(#timestamp)",
+            ExpressionAttributeNames={"#timestamp": "timestamp"},
+            ExpressionAttributeValues={
+                ":until": until,
+                ":fingerprint": plan["fingerprint"],
+                ":channel": recurring_poll["channel"],
+                ":scheduled": {
+                    str(k): v for k, v in plan["scheduled"].items() if k > now
+                },
+            },
+        )
+    except db_table.meta.client.exceptions.ConditionalCheckFailedException:
+        print("recurring poll", recurring_poll["uuid"], "was removed while scheduling")
+
+
+def _schedule_channel_polls(team, channel, recurring_polls):
+    now = int(time.time())
+    until = now + SCHEDULE_HORIZON_DAYS * 24 * 3600
+
+    legacy_posts = None
+    if any("scheduled_through" not in p for p in recurring_polls):
+        legacy_posts = {}
+        for scheduled_post in get_all_scheduled_posts(channel):
+            legacy_posts[get_message_id(scheduled_post)] = scheduled_post["id"]
+
+    plans = []
+    for recurring_poll in recurring_polls:
+        print("recurring_poll", recurring_poll)
+        plans.append(_plan_recurring_poll(recurring_poll, now, until, legacy_posts))
+
+    _schedule_pending(team, plans)
+    for plan in plans:
+        # nothing new in the horizon, the old watermark is still good enough
+        if len(plan["pending"]) > 0 or plan["changed"]:
+            _save_plan(plan, now, until)
+
+    if legacy_posts:
+        # Left over from polls that are gone, like the scheduler always did
+        print("deleting scheduled messages in", channel)
+        for msg_id in legacy_posts.values():
+            delete_scheduled_message(channel, msg_id)
+
+
+def _unschedule_removed_poll(team, poll_uuid, channel):
+    print("recurring poll", poll_uuid, "was removed, deleting its messages")
+    for scheduled_post in get_all_scheduled_posts(channel):
+        if get_message_id(scheduled_post).startswith(f"{poll_uuid}:"):
+            delete_scheduled_message(channel, scheduled_post["id"])
+    db_table.update_item(
+        Key=_planner_key(team),
+        UpdateExpression="REMOVE #polls.#uuid",
+        ExpressionAttributeNames={"#polls": "polls", "#uuid": poll_uuid},
+    )
+
+
+def _scheduler_pool():
+    # Kept for the life of the container, so its threads and their DynamoDB
+    # resources are reused by every tick
+    global _scheduler_executor
+    if _scheduler_executor is None:
+        _scheduler_executor = ThreadPoolExecutor(max_workers=SCHEDULER_WORKERS)
+    return _scheduler_executor
+
+
+def _schedule_teams(teams):
+    # A team or channel that fails is logged and skipped, the others still get
+    # their polls scheduled.
+    failed = 0
+    executor = _scheduler_pool()
+    team_jobs = {
+        executor.submit(_recurring_polls_by_channel, team): team for team in teams
+    }
+    channel_jobs = {}
+    for future in as_completed(team_jobs):
+        team = team_jobs[future]
+        try:
+            polls_by_channel, removed = future.result()
+        except Exception:
+            print("could not load recurring polls of team", team)
+            traceback.print_exc()
+            failed += 1
+            continue
+        for channel, recurring_polls in polls_by_channel.items():
+            job = executor.submit(
+                _schedule_channel_polls, team, channel, recurring_polls
+            )
+            channel_jobs[job] = (team, channel)
+        for poll_uuid, channel in removed.items():
+            job = executor.submit(_unschedule_removed_poll, team, poll_uuid, channel)
+            channel_jobs[job] = (team, channel)
+
+    for future in as_completed(channel_jobs):
+        try:
+            future.result()
+        except Exception:
+            print("could not schedule recurring polls of", *channel_jobs[future])
+            traceback.print_exc()
+            failed += 1
+    print("scheduled recurring polls of", len(teams), "teams,", failed, "failures")
+    print("slack api calls", slack_api_stats())
+    return failed
+
+
+def schedule_recurring_polls(team):
+    return _schedule_teams([team])
 
 
 @slack_view_submission("poll-create")
@@ -544,9 +1288,8 @@ def _handle_post_poll(data):
                     "recurring-sub-settings-tz": "Not a valid timezone. Use e.g. Europe/Amsterdam. For a full list see https://en.wikipedia.org/wiki/List_of_tz_database_time_zones."
                 },
             }
-        db_table.put_item(
-            Item={
-                "timestamp": int(time.time()) * 1000 + random.randint(0, 1000),
+        put_new_item(
+            {
                 "team": f"{team}:poll-recurring",
                 "recurring": recurring,
                 "created_by": created_by,
@@ -556,11 +1299,12 @@ def _handle_post_poll(data):
                 "title": title,
                 "channel": channel_id,
                 "uuid": str(uuid.uuid4()),
+                "scheduled_through": 0,
             }
         )
+        _register_recurring_team(team)
         return {}
 
-    msg_id = int(time.time()) * 1000 + random.randint(0, 1000)
     blocks, votes = get_blocks_for_polls(
         title,
         anonymous,
@@ -568,27 +1312,59 @@ def _handle_post_poll(data):
         texts,
         created_by,
         scheduled=False,
-        top_id=f":{msg_id}",
+        top_id=None,
     )
-
-    message_id = send_message(channel_id, blocks=blocks, text=title)
-    db_table.put_item(
-        Item={
+    # claim the key first, the message refers to it in its first block
+    msg_id = put_new_item(
+        {
             "team": f'{data["view"]["team_id"]}:poll',
-            "timestamp": msg_id,
             "created_by": created_by,
             "anonymous": anonymous,
             "votes": votes,
+            "tallies": {},
+            "counts": {},
             "limit_votes": limit_votes,
+            "title": title,
+            "options": texts,
+            "scheduled": False,
         }
     )
+    blocks[0]["block_id"] = f":{msg_id}"
+
+    message_id = send_message(channel_id, blocks=blocks, text=title)
 
     return {}
 
 
+def _voters_text(voters, count, anonymous, shown):
+    # Long voter lists are cut off, a section text can hold 3000 characters
+    if anonymous:
+        text = ":thumbsup:" * min(count, shown)
+    else:
+        text = " ".join(voters[:shown])
+    if count > shown:
+        text += f" and {count - shown} more"
+    return text
+
+
 def get_blocks_for_polls(
-    title, anonymous, limit_votes, texts, created_by, scheduled, top_id
+    title,
+    anonymous,
+    limit_votes,
+    texts,
+    created_by,
+    scheduled,
+    top_id,
+    voters=None,
+    counts=None,
 ):
+    # Up to nine options get an emoji button each. Larger polls list their
+    # options in compact context blocks and vote through one select menu, so
+    # they stay well below Slack's limit of 50 blocks per message.
+    if voters is None:
+        voters = {}
+    if counts is None:
+        counts = {}
     blocks = [
         {
             "type": "section",
@@ -600,16 +1376,36 @@ def get_blocks_for_polls(
         }
     ]
     votes = {}
+    large = len(texts) > SMALL_POLL_OPTIONS
     for idx, option in enumerate(texts):
         idx += 1
         votes[f"option-{idx}"] = []
+        option_voters = sorted(voters.get(f"option-{idx}", []))
+        option_count = int(counts.get(f"option-{idx}", len(option_voters)))
+        count = f" `{option_count}`" if option_count > 0 else ""
+        if large:
+            if (idx - 1) % 10 == 0:
+                blocks.append(
+                    {
+                        "type": "context",
+                        "block_id": f"options-{idx}",
+                        "elements": [],
+                    }
+                )
+            text = f"*{idx}.* {option}{count}"
+            if option_count > 0:
+                text += " " + _voters_text(
+                    option_voters, option_count, anonymous, LARGE_POLL_VOTERS_SHOWN
+                )
+            blocks[-1]["elements"].append({"type": "mrkdwn", "text": text})
+            continue
         blocks.append(
             {
                 "type": "section",
                 "block_id": f"option-{idx}",
                 "text": {
                     "type": "mrkdwn",
-                    "text": f":{to_num[idx]}: {option}",
+                    "text": f":{to_num[idx]}: {option}{count}",
                 },
                 "accessory": {
                     "type": "button",
@@ -617,7 +1413,7 @@ def get_blocks_for_polls(
                         "type": "plain_text",
                         "text": f":{to_num[idx]}:",
                     },
-                    "value": f"vote-{str(uuid.uuid4())}",
+                    "value": f"vote-{idx}",
                     "action_id": "vote-poll",
                 },
             }
@@ -625,11 +1421,51 @@ def get_blocks_for_polls(
         blocks.append(
             {
                 "type": "section",
-                "text": {"type": "mrkdwn", "text": " "},
+                "text": {
+                    "type": "mrkdwn",
+                    "text": _voters_text(
+                        option_voters, option_count, anonymous, VOTERS_SHOWN
+                    )
+                    + " ",
+                },
                 "block_id": f"option-{idx}-people",
             }
         )
 
+    actions = [
+        {
+            "type": "button",
+            "text": _plain_text("Close poll"),
+            "value": "close",
+            "action_id": "close-poll",
+        }
+    ]
+    shown = LARGE_POLL_VOTERS_SHOWN if large else VOTERS_SHOWN
+    if not anonymous and any(int(count) > shown for count in counts.values()):
+        actions.insert(
+            0,
+            {
+                "type": "button",
+                "text": _plain_text("Show all voters"),
+                "value": "voters",
+                "action_id": "show-voters",
+            },
+        )
+    if large:
+        actions.insert(
+            0,
+            {
+                "type": "static_select",
+                "action_id": "vote-poll",
+                "placeholder": _plain_text("Vote or remove your vote"),
+                "options": [
+                    _select_option(f"{idx}. {option}"[:75], f"option-{idx}")
+                    for idx, option in enumerate(texts, start=1)
+                ],
+            },
+        )
+    blocks.append({"type": "actions", "block_id": "poll-actions", "elements": actions})
+
     blocks.append(
         {
             "type": "context",
@@ -644,7 +1480,22 @@ def get_blocks_for_polls(
     return blocks, votes
 
 
-def schedule_all_recurring_polls():
+# One well-known item lists the teams that have recurring polls, so the
+# scheduler does not have to scan the whole table on every tick.
+RECURRING_REGISTRY_KEY = {"timestamp": meta_key("*", "recurring-poll-teams")}
+
+
+def _register_recurring_team(team):
+    db_table.update_item(
+        Key=RECURRING_REGISTRY_KEY,
+        UpdateExpression="SET #team = :registry ADD #teams :team",
+        ExpressionAttributeNames={"#team": "team", "#teams": "teams"},
+        ExpressionAttributeValues={":registry": "*:meta", ":team": {team}},
+    )
+
+
+def _scan_recurring_teams():
+    # Only needed once, to fill the registry with the teams from before it
     scan_kwargs = {
         "FilterExpression": Attr("recurring").exists(),
         "ProjectionExpression": "team",
@@ -662,6 +1513,29 @@ def schedule_all_recurring_polls():
                 teams.add(item["team"].split(":")[0])
         start_key = response.get("LastEvaluatedKey", None)
         done = start_key is None
+    return teams
+
+
+def schedule_all_recurring_polls():
+    registry = db_table.get_item(Key=RECURRING_REGISTRY_KEY).get("Item")
+    if registry is not None and registry.get("complete", False):
+        teams = registry.get("teams", set())
+    else:
+        teams = _scan_recurring_teams()
+        db_table.update_item(
+            Key=RECURRING_REGISTRY_KEY,
+            UpdateExpression="SET #team = :registry, #complete = :true"
+            + (" ADD #teams :teams" if len(teams) > 0 else ""),
+            ExpressionAttributeNames={
+                "#team": "team",
+                "#complete": "complete",
+                **({"#teams": "teams"} if len(teams) > 0 else {}),
+            },
+            ExpressionAttributeValues={
+                ":registry": "*:meta",
+                ":true": True,
+                **({":teams": teams} if len(teams) > 0 else {}),
+            },
+        )
 
-    for team in teams:
-        schedule_recurring_polls(team)
+    _schedule_teams(teams)
@@ -1,34 +1,543 @@
-from util import DATABASE_INDEX_NAME
+from util import DATABASE_INDEX_NAME, PERSON_INDEX_NAME
 from boto3.dynamodb.conditions import Key
 import random
-from util import slack_command, db_table
+import re
+from util import (
+    slack_command,
+    db_table,
+    upload_file,
+    meta_key,
+    batch_get_items,
+    batch_write_items,
+    migration,
+    query_items,
+    put_new_item,
+)
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import calendar
+import collections
+import csv
 import datetime
-import time
+import io
+import sys
+import tempfile
+import zlib
 
+SEARCH_TOKEN_RE = re.compile(r"\w+")
 
-def _get_all_quotes(slack_team):
-    all_quotes = db_table.query(
+# Substring search indexes the three character windows of every quote. The
+# postings are split in buckets of SEARCH_BUCKET_QUOTES quotes and spread over
+# SEARCH_SHARDS items per bucket, which keeps every item far below DynamoDB's
+# 400 KB item limit.
+SEARCH_BUCKET_QUOTES = 500
+SEARCH_SHARDS = 64
+SEARCH_MAX_TRIGRAMS = 4
+SEARCH_MAX_CANDIDATES = 1000
+_search_index_executor = ThreadPoolExecutor(max_workers=8)
+
+# Trigrams of every quote are hashed into a fixed size bitset when the quote
+# is added. Fuzzy search then only needs a bitwise AND and a popcount per quote.
+SIGNATURE_BITS = 1024
+FUZZY_MIN_SCORE = 0.5
+FUZZY_RECENCY_WEIGHT = 0.1
+
+# Lambda keeps the module loaded between invocations of a warm container.
+# Per team: (negated timestamps ascending, Quote records newest first, size in
+# bytes, quotes version the entry was read at).
+QUOTE_CACHE_MAX_TEAMS = 32
+QUOTE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+_quote_cache = collections.OrderedDict()
+
+
+class Quote(
+    collections.namedtuple(
+        "Quote", ["timestamp", "message", "signature"], defaults=(None,)
+    )
+):
+    # Formatting is deferred to __str__, so only the rows that are actually
+    # shown to the user pay for the datetime conversion.
+    __slots__ = ()
+
+    @classmethod
+    def from_item(cls, item):
+        signature = None
+        if "signature" in item:
+            signature = int.from_bytes(item["signature"].value, "big")
+        return cls(int(item["timestamp"]), str(item["message"]), signature)
+
+    @property
+    def created(self):
+        return str(datetime.datetime.fromtimestamp(self.timestamp // 1000))
+
+    def __str__(self):
+        return self.created + " (UTC) - " + self.message
+
+
+def _trigram_signature(text):
+    signature = 0
+    for word in SEARCH_TOKEN_RE.findall(text.lower()):
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            trigram = padded[i : i + 3].encode()
+            signature |= 1 << (zlib.crc32(trigram) % SIGNATURE_BITS)
+    return signature
+
+
+def _signature_bytes(signature):
+    return signature.to_bytes(SIGNATURE_BITS // 8, "big")
+
+
+def _fuzzy_search(quotes, message):
+    # quotes are ordered newest first
+    query = _trigram_signature(message)
+    wanted = bin(query).count("1")
+    if wanted == 0 or len(quotes) == 0:
+        return []
+    oldest = quotes[-1].timestamp
+    span = max(quotes[0].timestamp - oldest, 1)
+    ranked = []
+    for quote in quotes:
+        signature = quote.signature
+        if signature is None:
+            signature = _trigram_signature(quote.message)
+        score = bin(query & signature).count("1") / wanted
+        if score >= FUZZY_MIN_SCORE:
+            recency = (quote.timestamp - oldest) / span
+            ranked.append((score + FUZZY_RECENCY_WEIGHT * recency, quote))
+    ranked.sort(key=lambda x: x[0], reverse=True)
+    return [quote for _, quote in ranked]
+
+
+def _render_quotes(header, quotes):
+    return "\n - ".join([header] + list(map(str, quotes)))
+
+
+def _iter_quote_items(slack_team, limit=None):
+    return query_items(
+        limit=limit,
         IndexName=DATABASE_INDEX_NAME,
         KeyConditionExpression=Key("team").eq(slack_team),
         ScanIndexForward=False,
     )
-    return list(
-        map(
-            lambda item: str(
-                datetime.datetime.fromtimestamp(int(item["timestamp"] / 1000))
+
+
+def _quoted_person(message):
+    # "@Alice: something" -> "@alice"
+    return message.split(" ")[0].lower().rstrip(":,.")
+
+
+def _person_key(slack_team, person):
+    return f"{slack_team}#{person}"
+
+
+def _person_index_ready(slack_team):
+    item = db_table.get_item(
+        Key={"timestamp": meta_key(slack_team, "person-index")}
+    ).get("Item")
+    return item is not None and item.get("complete", False)
+
+
+def _iter_person_quote_items(slack_team, person, limit=None):
+    return query_items(
+        limit=limit,
+        IndexName=PERSON_INDEX_NAME,
+        KeyConditionExpression=Key("person").eq(_person_key(slack_team, person)),
+        ScanIndexForward=False,
+    )
+
+
+def _latest_quote_timestamp(slack_team):
+    for item in _iter_quote_items(slack_team, limit=1):
+        return int(item["timestamp"])
+    return None
+
+
+def _quotes_version_key(slack_team):
+    return {"timestamp": meta_key(slack_team, "quotes-version")}
+
+
+def _quotes_version(slack_team):
+    # Bumped after every write of quotes, also back-dated ones from an import,
+    # so it tells other containers their cache is stale.
+    item = db_table.get_item(
+        Key=_quotes_version_key(slack_team), ConsistentRead=True
+    ).get("Item")
+    return 0 if item is None else int(item["version"])
+
+
+def _bump_quotes_version(slack_team):
+    response = db_table.update_item(
+        Key=_quotes_version_key(slack_team),
+        UpdateExpression="SET #team = :team ADD #version :one",
+        ExpressionAttributeNames={"#team": "team", "#version": "version"},
+        ExpressionAttributeValues={":team": f"{slack_team}:meta", ":one": 1},
+        ReturnValues="UPDATED_NEW",
+    )
+    return int(response["Attributes"]["version"])
+
+
+def _quote_size(quote):
+    # the record, its fields, the negated timestamp and a slot in both lists
+    size = sys.getsizeof(quote) + 2 * sys.getsizeof(quote.timestamp) + 16
+    size += sys.getsizeof(quote.message) + sys.getsizeof(quote.signature)
+    return size
+
+
+def _cached_quotes(slack_team):
+    # Only trust the cache while no other container wrote quotes since
+    if slack_team not in _quote_cache:
+        return None
+    timestamps, quotes, size, version = _quote_cache[slack_team]
+    if version != _quotes_version(slack_team):
+        del _quote_cache[slack_team]
+        return None
+    _quote_cache.move_to_end(slack_team)
+    return quotes
+
+
+def _store_cached_quotes(slack_team, timestamps, quotes, size, version):
+    _quote_cache.pop(slack_team, None)
+    if size > QUOTE_CACHE_MAX_BYTES:
+        return
+    _quote_cache[slack_team] = (timestamps, quotes, size, version)
+    while (
+        len(_quote_cache) > QUOTE_CACHE_MAX_TEAMS
+        or sum(entry[2] for entry in _quote_cache.values()) > QUOTE_CACHE_MAX_BYTES
+    ):
+        _quote_cache.popitem(last=False)
+
+
+def _write_through_quote(slack_team, timestamp, message, signature, version):
+    if slack_team not in _quote_cache:
+        return
+    timestamps, quotes, size, cached_version = _quote_cache[slack_team]
+    if cached_version != version - 1:
+        # another container wrote quotes in between
+        del _quote_cache[slack_team]
+        return
+    quote = Quote(timestamp, message, signature)
+    position = bisect.bisect(timestamps, -timestamp)
+    timestamps.insert(position, -timestamp)
+    quotes.insert(position, quote)
+    size += _quote_size(quote)
+    _store_cached_quotes(slack_team, timestamps, quotes, size, version)
+
+
+def _get_all_quotes(slack_team):
+    # newest first, the list is shared with the cache so don't modify it
+    quotes = _cached_quotes(slack_team)
+    if quotes is None:
+        # read before the quotes, a write in between only causes a reload
+        version = _quotes_version(slack_team)
+        timestamps = []
+        quotes = []
+        size = 0
+        for item in _iter_quote_items(slack_team):
+            quote = Quote.from_item(item)
+            timestamps.append(-quote.timestamp)
+            quotes.append(quote)
+            size += _quote_size(quote)
+        _store_cached_quotes(slack_team, timestamps, quotes, size, version)
+    return quotes
+
+
+def _get_latest_quotes(slack_team, skip=0, count=10):
+    quotes = _cached_quotes(slack_team)
+    if quotes is not None:
+        return quotes[skip : skip + count]
+    items = list(_iter_quote_items(slack_team, limit=skip + count))
+    return list(map(Quote.from_item, items[skip:]))
+
+
+def _trigrams(text):
+    text = text.lower()
+    return [text[i : i + 3] for i in range(len(text) - 2)]
+
+
+def _search_meta_key(slack_team):
+    return {"timestamp": meta_key(slack_team, "search-trigrams")}
+
+
+def _search_shard_key(slack_team, bucket, shard):
+    return {"timestamp": meta_key(slack_team, f"search-trigrams:{bucket}:{shard}")}
+
+
+def _postings_by_shard(trigrams):
+    shards = {}
+    for trigram in trigrams:
+        shard = zlib.crc32(trigram.encode()) % SEARCH_SHARDS
+        shards.setdefault(shard, set()).add(trigram)
+    return shards
+
+
+def _add_postings(slack_team, bucket, shard, trigrams, timestamp):
+    names = {"#team": "team"}
+    values = {":team": f"{slack_team}:search-index", ":quote": {timestamp}}
+    for i, trigram in enumerate(sorted(trigrams)):
+        names[f"#t{i}"] = f"t:{trigram}"
+    db_table.update_item(
+        Key=_search_shard_key(slack_team, bucket, shard),
+        UpdateExpression="SET #team = :team ADD "
+        + ", ".join(f"#t{i} :quote" for i in range(len(trigrams))),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values,
+    )
+
+
+def _index_quote(slack_team, timestamp, message):
+    counter = db_table.update_item(
+        Key=_search_meta_key(slack_team),
+        UpdateExpression="SET #team = :team ADD #quotes :one",
+        ExpressionAttributeNames={"#team": "team", "#quotes": "quotes"},
+        ExpressionAttributeValues={":team": f"{slack_team}:meta", ":one": 1},
+        ReturnValues="UPDATED_NEW",
+    )
+    bucket = (int(counter["Attributes"]["quotes"]) - 1) // SEARCH_BUCKET_QUOTES
+    futures = [
+        _search_index_executor.submit(
+            _add_postings, slack_team, bucket, shard, trigrams, timestamp
+        )
+        for shard, trigrams in _postings_by_shard(_trigrams(message)).items()
+    ]
+    for future in futures:
+        future.result()
+
+
+def _search_candidates(slack_team, message):
+    # Returns the quotes that contain a few trigrams of the search text, or
+    # None when the index can't help and we have to scan.
+    trigrams = _trigrams(message)
+    if len(trigrams) == 0:
+        return None
+    meta = db_table.get_item(Key=_search_meta_key(slack_team)).get("Item")
+    if meta is None or not meta.get("complete", False):
+        return None
+    # trigrams spread over the text, the substring check does the rest
+    picked = min(SEARCH_MAX_TRIGRAMS, len(trigrams))
+    trigrams = set(
+        trigrams[i * (len(trigrams) - 1) // max(picked - 1, 1)] for i in range(picked)
+    )
+    quote_count = int(meta.get("quotes", 0))
+    buckets = range((quote_count + SEARCH_BUCKET_QUOTES - 1) // SEARCH_BUCKET_QUOTES)
+    shards = _postings_by_shard(trigrams)
+    names = {f"#t{i}": f"t:{trigram}" for i, trigram in enumerate(trigrams)}
+    items = batch_get_items(
+        (
+            _search_shard_key(slack_team, bucket, shard)
+            for bucket in buckets
+            for shard in shards
+        ),
+        ProjectionExpression=", ".join(names),
+        ExpressionAttributeNames=names,
+    )
+    postings = {trigram: set() for trigram in trigrams}
+    for item in items:
+        for trigram in trigrams:
+            postings[trigram] |= item.get(f"t:{trigram}", set())
+    candidates = set.intersection(*postings.values())
+    if len(candidates) > SEARCH_MAX_CANDIDATES:
+        return None
+    items = batch_get_items({"timestamp": timestamp} for timestamp in candidates)
+    return sorted(
+        (Quote.from_item(item) for item in items if item["team"] == slack_team),
+        key=lambda quote: quote.timestamp,
+        reverse=True,
+    )
+
+
+def _quote_counter_key(slack_team):
+    return {"timestamp": meta_key(slack_team, "quote-counter")}
+
+
+def _quote_ordinal_item(slack_team, ordinal, timestamp, message):
+    return {
+        "timestamp": meta_key(slack_team, f"quote-ordinal:{ordinal}"),
+        "team": f"{slack_team}:quote-ordinal",
+        "ordinal": ordinal,
+        "quote": timestamp,
+        "message": message,
+    }
+
+
+def _assign_ordinal(slack_team, timestamp, message):
+    counter = db_table.update_item(
+        Key=_quote_counter_key(slack_team),
+        UpdateExpression="SET #team = :team ADD #count :one",
+        ExpressionAttributeNames={"#team": "team", "#count": "count"},
+        ExpressionAttributeValues={":team": f"{slack_team}:meta", ":one": 1},
+        ReturnValues="UPDATED_NEW",
+    )
+    ordinal = int(counter["Attributes"]["count"])
+    db_table.put_item(
+        Item=_quote_ordinal_item(slack_team, ordinal, timestamp, message)
+    )
+
+
+def _get_random_quote(slack_team):
+    # Returns None when the ordinals were never backfilled for this team
+    counter = db_table.get_item(Key=_quote_counter_key(slack_team)).get("Item")
+    if counter is None or not counter.get("complete", False):
+        return None
+    count = int(counter["count"])
+    if count == 0:
+        return None
+    ordinal = random.randint(1, count)
+    pointer = db_table.get_item(
+        Key={"timestamp": meta_key(slack_team, f"quote-ordinal:{ordinal}")}
+    ).get("Item")
+    if pointer is None:
+        # the counter was bumped but the quote is still being written
+        return None
+    return Quote(int(pointer["quote"]), str(pointer["message"]))
+
+
+def _mark_indexes_complete(slack_team):
+    # A team without old quotes has nothing to backfill, its indexes are
+    # complete from the first quote on.
+    db_table.update_item(
+        Key=_quote_counter_key(slack_team),
+        UpdateExpression="SET #team = :team, #complete = :true",
+        ExpressionAttributeNames={"#team": "team", "#complete": "complete"},
+        ExpressionAttributeValues={":team": f"{slack_team}:meta", ":true": True},
+    )
+    for name in ("search-trigrams", "person-index"):
+        db_table.update_item(
+            Key={"timestamp": meta_key(slack_team, name)},
+            UpdateExpression="SET #team = :team, #complete = :true",
+            ExpressionAttributeNames={"#team": "team", "#complete": "complete"},
+            ExpressionAttributeValues={":team": f"{slack_team}:meta", ":true": True},
+        )
+
+
+@migration("quote-ordinals")
+def backfill_quote_ordinals(slack_team):
+    timestamps = sorted(
+        (item["timestamp"], str(item["message"]))
+        for item in _iter_quote_items(slack_team)
+    )
+    with db_table.batch_writer() as batch:
+        for ordinal, (timestamp, message) in enumerate(timestamps, start=1):
+            batch.put_item(
+                Item=_quote_ordinal_item(slack_team, ordinal, timestamp, message)
             )
-            + " (UTC) - "
-            + str(item["message"]),
-            all_quotes["Items"],
+    db_table.put_item(
+        Item={
+            **_quote_counter_key(slack_team),
+            "team": f"{slack_team}:meta",
+            "count": len(timestamps),
+            "complete": True,
+        }
+    )
+    return f"Assigned ordinals to {len(timestamps)} quotes"
+
+
+@migration("quote-signatures")
+def backfill_quote_signatures(slack_team):
+    count = 0
+    for item in _iter_quote_items(slack_team):
+        if "signature" in item:
+            continue
+        db_table.update_item(
+            Key={"timestamp": item["timestamp"]},
+            UpdateExpression="SET #signature = :signature",
+            ExpressionAttributeNames={"#signature": "signature"},
+            ExpressionAttributeValues={
+                ":signature": _signature_bytes(
+                    _trigram_signature(str(item["message"]))
+                )
+            },
+        )
+        count += 1
+    return f"Added trigram signatures to {count} quotes"
+
+
+@migration("person-index")
+def backfill_quote_persons(slack_team):
+    count = 0
+    for item in _iter_quote_items(slack_team):
+        person = _person_key(slack_team, _quoted_person(str(item["message"])))
+        if item.get("person") == person:
+            continue
+        db_table.update_item(
+            Key={"timestamp": item["timestamp"]},
+            UpdateExpression="SET #person = :person",
+            ExpressionAttributeNames={"#person": "person"},
+            ExpressionAttributeValues={":person": person},
         )
+        count += 1
+    db_table.put_item(
+        Item={
+            "timestamp": meta_key(slack_team, "person-index"),
+            "team": f"{slack_team}:meta",
+            "complete": True,
+        }
     )
+    return f"Added the quoted person to {count} quotes"
 
 
-@slack_command("/add-quote")
-def _bot_add_quote(data):
-    message = data.get("text")
-    slack_team = data["team_id"]
+@migration("search-index")
+def rebuild_search_index(slack_team):
+    def write_bucket(batch, bucket, postings):
+        for shard, trigrams in postings.items():
+            batch.put_item(
+                Item={
+                    **_search_shard_key(slack_team, bucket, shard),
+                    "team": f"{slack_team}:search-index",
+                    **{f"t:{trigram}": quotes for trigram, quotes in trigrams.items()},
+                }
+            )
+
+    quote_count = 0
+    postings = {}
+    with db_table.batch_writer() as batch:
+        for item in _iter_quote_items(slack_team):
+            for trigram in _trigrams(str(item["message"])):
+                shard = zlib.crc32(trigram.encode()) % SEARCH_SHARDS
+                postings.setdefault(shard, {}).setdefault(trigram, set()).add(
+                    item["timestamp"]
+                )
+            quote_count += 1
+            if quote_count % SEARCH_BUCKET_QUOTES == 0:
+                write_bucket(batch, quote_count // SEARCH_BUCKET_QUOTES - 1, postings)
+                postings = {}
+        if len(postings) > 0:
+            write_bucket(batch, quote_count // SEARCH_BUCKET_QUOTES, postings)
+    db_table.put_item(
+        Item={
+            **_search_meta_key(slack_team),
+            "team": f"{slack_team}:meta",
+            "quotes": quote_count,
+            "complete": True,
+        }
+    )
+    return f"Indexed {quote_count} quotes"
+
+
+def _export_quotes(slack_team, channel_id):
+    # Streams the pages of the query into a CSV file on /tmp, so memory use
+    # does not depend on the size of the archive.
+    count = 0
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["date (UTC)", "quote"])
+        for item in _iter_quote_items(slack_team):
+            quote = Quote.from_item(item)
+            writer.writerow([quote.created, quote.message])
+            count += 1
+        f.flush()
+        if count > 0:
+            upload_file(
+                channel_id,
+                f.name,
+                filename="quotes.csv",
+                title="All quotes",
+                comment=f"Here are all {count} quotes",
+            )
+    return count
+
 
+def _validate_quote(message):
     if message is None:
         return "A quote must have a text... Try again with '/add-quote I am an idiot'"
     parts = message.split(" ")
@@ -36,66 +545,232 @@ def _bot_add_quote(data):
         return "The quote must start with the slack name of a user (including @)"
     if len(parts) < 2:
         return "Very good, but now the person must say something, try '/add-quote @user: I am an idiot'"
-    db_table.put_item(
-        Item={
-            "team": slack_team,
-            "timestamp": int(time.time()) * 1000 + random.randint(0, 1000),
-            "message": message,
-        }
+    return None
+
+
+def _quote_item(slack_team, timestamp, message, signature):
+    return {
+        "team": slack_team,
+        "timestamp": timestamp,
+        "message": message,
+        "signature": _signature_bytes(signature),
+        "person": _person_key(slack_team, _quoted_person(message)),
+    }
+
+
+def _free_import_keys(items):
+    # The key is shared by every team and every kind of item. Back-dated keys
+    # that another item already has are moved up to the next free millisecond,
+    # moved keys are checked again in the next round.
+    planned = set(item["timestamp"] for item in items)
+    taken = set()
+    to_check = items
+    while len(to_check) > 0:
+        taken.update(
+            int(item["timestamp"])
+            for item in batch_get_items(
+                {"timestamp": item["timestamp"]} for item in to_check
+            )
+        )
+        moved = []
+        for item in to_check:
+            if item["timestamp"] not in taken:
+                continue
+            planned.discard(item["timestamp"])
+            timestamp = item["timestamp"] + 1
+            while timestamp in taken or timestamp in planned:
+                timestamp += 1
+            item["timestamp"] = timestamp
+            planned.add(timestamp)
+            moved.append(item)
+        to_check = moved
+    return items
+
+
+@migration("import-quotes")
+def import_quotes(slack_team, csv_text, max_items_per_second=500):
+    # Accepts the format of the '/last-quotes all' export: a "date (UTC)"
+    # column (may be empty) and a "quote" column.
+    existing = set(str(item["message"]) for item in _iter_quote_items(slack_team))
+    first_quotes = len(existing) == 0
+    used_timestamps = set()
+    items = []
+    undated = []
+    errors = []
+    for line, row in enumerate(csv.reader(io.StringIO(csv_text)), start=1):
+        if len(row) == 0 or row == ["date (UTC)", "quote"]:
+            continue
+        date, message = ("", row[0]) if len(row) == 1 else row[:2]
+        message = message.strip()
+        error = _validate_quote(message)
+        if error is not None:
+            errors.append(f"line {line}: {error}")
+            continue
+        if message in existing:
+            continue
+        existing.add(message)
+        signature = _trigram_signature(message)
+        if len(date.strip()) == 0:
+            undated.append(_quote_item(slack_team, None, message, signature))
+            continue
+        try:
+            created = datetime.datetime.fromisoformat(date.strip())
+        except ValueError:
+            errors.append(f"line {line}: can not read date '{date}'")
+            continue
+        timestamp = calendar.timegm(created.timetuple()) * 1000
+        while timestamp in used_timestamps:
+            timestamp += 1
+        used_timestamps.add(timestamp)
+        items.append(_quote_item(slack_team, timestamp, message, signature))
+
+    batch_write_items(
+        _free_import_keys(items), max_items_per_second=max_items_per_second
     )
+    # undated quotes get current keys, which live writes claim too
+    for item in undated:
+        put_new_item(item)
+    if len(items) + len(undated) > 0:
+        _bump_quotes_version(slack_team)
+        rebuild_search_index(slack_team)
+        backfill_quote_ordinals(slack_team)
+        if first_quotes:
+            # every imported quote already has its person
+            _mark_indexes_complete(slack_team)
+    return {"imported": len(items) + len(undated), "errors": errors}
+
+
+@slack_command("/add-quote")
+def _bot_add_quote(data):
+    message = data.get("text")
+    slack_team = data["team_id"]
+
+    error = _validate_quote(message)
+    if error is not None:
+        return error
+    signature = _trigram_signature(message)
+    first_quote = _latest_quote_timestamp(slack_team) is None
+    timestamp = put_new_item(_quote_item(slack_team, None, message, signature))
+    _index_quote(slack_team, timestamp, message)
+    _assign_ordinal(slack_team, timestamp, message)
+    if first_quote:
+        _mark_indexes_complete(slack_team)
+    version = _bump_quotes_version(slack_team)
+    _write_through_quote(slack_team, timestamp, message, signature, version)
     return "Thanks! Your quote was preserved for future generations."
 
 
-@slack_command("/last-quotes")
+@slack_command("/last-quotes", deferred=True)
 def _bot_last_quotes(data):
     message = data.get("text")
     slack_team = data["team_id"]
-    all_quotes = _get_all_quotes(slack_team)
-    if len(all_quotes) == 0:
-        return "No quotes were found"
+    if message == "all":
+        if _export_quotes(slack_team, data["channel_id"]) == 0:
+            return "No quotes were found"
+        return "Here are all quotes, see the attached file"
     if message is None:
-        return "\n - ".join(["Here are the latest quotes:"] + all_quotes[:10])
-    elif message == "all":
-        return "\n - ".join(["Here are all quotes:"] + all_quotes)
+        skip = 0
     else:
         try:
             skip = int(message)
         except ValueError:
             return "You can use /last-quotes with a number to skip a number of quotes. Example: '/last-quotes 30' will skip the 30 latest quotes"
-        return "\n - ".join(
-            [f"Here are some quotes skipping the first {skip}:"]
-            + all_quotes[skip : skip + 10]
-        )
+    if skip < 0:
+        skip = 0
+    quotes = _get_latest_quotes(slack_team, skip=skip)
+    if len(quotes) == 0:
+        return "No quotes were found"
+    if message is None:
+        return _render_quotes("Here are the latest quotes:", quotes)
+    return _render_quotes(f"Here are some quotes skipping the first {skip}:", quotes)
 
 
 @slack_command("/random-quote")
 def _bot_random_quote(data):
     slack_team = data["team_id"]
-    all_quotes = _get_all_quotes(slack_team)
-    if len(all_quotes) == 0:
-        return "No quotes were found"
-    quote = random.choice(all_quotes)
+    quote = _get_random_quote(slack_team)
+    if quote is None:
+        all_quotes = _get_all_quotes(slack_team)
+        if len(all_quotes) == 0:
+            return "No quotes were found"
+        quote = random.choice(all_quotes)
     return f"Ok, here is your random quote:\n{quote}"
 
 
-@slack_command("/search-quotes")
+def _search_matches(slack_team, message):
+    needle = message.lower()
+    if message.startswith("@") and _person_index_ready(slack_team):
+        # "@alice pizza" only looks at the quotes of alice
+        person, _, needle = needle.partition(" ")
+        items = _iter_person_quote_items(slack_team, person.rstrip(":,."))
+        return [
+            quote
+            for quote in map(Quote.from_item, items)
+            if needle in quote.message.lower()
+        ]
+    candidates = _search_candidates(slack_team, message)
+    if candidates is not None:
+        return [quote for quote in candidates if needle in quote.message.lower()]
+    return [
+        quote
+        for quote in _get_all_quotes(slack_team)
+        if needle in quote.message.lower()
+    ]
+
+
+@slack_command("/search-quotes", deferred=True)
 def _bot_search_quotes(data):
     message = data.get("text")
     slack_team = data["team_id"]
     if message is None or len(message) == 0:
         return "We need some text to search for! Try '/search-quote hi'"
-    all_quotes = _get_all_quotes(slack_team)
     unlimited = message.endswith(" unlimited")
     if unlimited:
         message = message[: -len(" unlimited")]
-
-    matches = list(filter(lambda x: message.lower() in x.lower(), all_quotes))
+    if message.endswith(" fuzzy"):
+        return _fuzzy_search_quotes(slack_team, message[: -len(" fuzzy")], unlimited)
+    matches = _search_matches(slack_team, message)
     if len(matches) == 0:
         return "No quote found! Sorry. Just keep adding more of them."
     elif unlimited:
-        return "\n - ".join(
-            ["You found the unlimited function, you are 1337:"] + matches
+        return _render_quotes(
+            "You found the unlimited function, you are 1337:", matches
         )
     else:
         random.shuffle(matches)
-        return "\n - ".join(["This is what I found (limited to 10): \n"] + matches[:10])
+        return _render_quotes("This is what I found (limited to 10): \n", matches[:10])
+
+
+@slack_command("/quotes-by", deferred=True)
+def _bot_quotes_by(data):
+    message = data.get("text")
+    slack_team = data["team_id"]
+    if message is None or not message.startswith("@"):
+        return "Tell me whose quotes you want to see, try '/quotes-by @user'"
+    person, _, skip = message.partition(" ")
+    person = person.lower().rstrip(":,.")
+    try:
+        skip = int(skip) if len(skip) > 0 else 0
+    except ValueError:
+        return "You can add a number to skip quotes. Example: '/quotes-by @user 10' will skip the 10 latest quotes"
+    if _person_index_ready(slack_team):
+        items = list(_iter_person_quote_items(slack_team, person, limit=skip + 10))
+        quotes = list(map(Quote.from_item, items[skip:]))
+    else:
+        quotes = [
+            quote
+            for quote in _get_all_quotes(slack_team)
+            if _quoted_person(quote.message) == person
+        ][skip : skip + 10]
+    if len(quotes) == 0:
+        return f"No quotes of {person} were found"
+    return _render_quotes(f"Here are the latest quotes of {person}:", quotes)
+
+
+def _fuzzy_search_quotes(slack_team, message, unlimited):
+    matches = _fuzzy_search(_get_all_quotes(slack_team), message)
+    if len(matches) == 0:
+        return "No quote found, not even a fuzzy one! Sorry."
+    elif unlimited:
+        return _render_quotes("Best matches first, you are 1337:", matches)
+    return _render_quotes("Best fuzzy matches (limited to 10):", matches[:10])
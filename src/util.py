@@ -1,10 +1,17 @@
 import base64
 import boto3
+import collections
 import hashlib
 import hmac
+import json
 import os
+import queue
+import random
 import requests
+import threading
 import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     SLACK_SIGNING_SECRET = os.environ["SLACK_SIGNING_SECRET"]
@@ -25,7 +32,32 @@ except KeyError:
     )
 
 
+# Point this at a local stub server to exercise the API helpers without Slack
+SLACK_API_URL = os.environ.get("SLACK_API_URL", "https://slack.com/api")
+SLACK_HEADERS = {"Authorization": f"Bearer {BEARER_TOKEN}"}
+# (connect, read) in seconds, and connections kept per host for the threads
+SLACK_TIMEOUT = (3.05, 10)
+SLACK_POOL_SIZE = 10
+# Calls per minute of Slack's rate limit tiers and the tier of the methods we
+# use. A throttled call waits for Retry-After plus jitter, SLACK_MAX_ATTEMPTS
+# times at most.
+SLACK_TIER_CALLS_PER_MINUTE = {2: 20, 3: 50, 4: 100}
+SLACK_METHOD_TIERS = {
+    "chat.postMessage": 4,
+    "chat.scheduleMessage": 3,
+    "chat.deleteScheduledMessage": 3,
+    "chat.scheduledMessages.list": 3,
+    "chat.update": 3,
+    "views.open": 4,
+    "views.update": 4,
+    "conversations.info": 3,
+    "files.getUploadURLExternal": 4,
+    "files.completeUploadExternal": 4,
+}
+SLACK_MAX_ATTEMPTS = 5
+
 DATABASE_INDEX_NAME = "team-timestamp-index"
+PERSON_INDEX_NAME = "person-timestamp-index"
 DATABASE_TABLE = "quotes"
 
 SLACK_CALLBACK_HANDLERS = {
@@ -38,33 +70,298 @@ SLACK_CALLBACK_HANDLERS = {
 }
 
 
-db_table = boto3.resource("dynamodb").Table(DATABASE_TABLE)
+# (callback_type, key) of handlers that run after Slack got its answer
+DEFERRED_CALLBACKS = set()
+
+MIGRATIONS = {}
+
+
+_session = boto3.session.Session()
+_session_lock = threading.Lock()
+_thread_resources = threading.local()
+
+
+def _thread_dynamodb():
+    # boto3 resources must not be shared between threads, and the scheduler
+    # and the batch writer run on threads of their own. Every thread gets its
+    # own resource the first time it touches the table. They all come from one
+    # session, which loads the service model once for the whole container.
+    if not hasattr(_thread_resources, "dynamodb"):
+        with _session_lock:
+            _thread_resources.dynamodb = _session.resource("dynamodb")
+        _thread_resources.table = _thread_resources.dynamodb.Table(DATABASE_TABLE)
+    return _thread_resources
+
+
+class _PerThread:
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(getattr(_thread_dynamodb(), self.name), attribute)
+
 
+dynamodb = _PerThread("dynamodb")
+db_table = _PerThread("table")
 
-def _slack_callback_handler(callback_type, command):
+_last_id = 0
+
+
+def meta_key(team, name):
+    # The table is keyed on "timestamp" alone, so bookkeeping items (indexes,
+    # counters) get a stable negative key that never collides with real items.
+    digest = hashlib.sha256(f"{team}:{name}".encode()).hexdigest()
+    return -int(digest[:15], 16)
+
+
+def new_id():
+    # Real milliseconds, made strictly increasing within this container so a
+    # burst in the same millisecond still gets ordered, distinct keys.
+    global _last_id
+    _last_id = max(int(time.time() * 1000), _last_id + 1)
+    return _last_id
+
+
+def put_new_item(item, first_id=None):
+    # Claims a fresh key with a conditional put, so concurrent containers that
+    # mint the same id can never overwrite each other's items.
+    candidate = new_id() if first_id is None else first_id
+    for _ in range(100):
+        item["timestamp"] = candidate
+        try:
+            db_table.put_item(
+                Item=item,
+                ConditionExpression="attribute_not_exists(#timestamp)",
+                ExpressionAttributeNames={"#timestamp": "timestamp"},
+            )
+            return candidate
+        except db_table.meta.client.exceptions.ConditionalCheckFailedException:
+            candidate = new_id() if first_id is None else candidate + 1
+    raise Exception("Could not find a free key for the new item")
+
+
+def claim_job(job_id, keep_seconds=24 * 3600):
+    # True the first time a job id is seen. Asynchronous invocations are retried
+    # by Lambda after errors and timeouts, this lets a retry skip the job
+    # instead of running it twice (and toggling a vote back).
+    try:
+        db_table.put_item(
+            Item={
+                "timestamp": meta_key("*", f"job:{job_id}"),
+                "team": "*:job",
+                "expires": int(time.time()) + keep_seconds,
+            },
+            ConditionExpression="attribute_not_exists(#timestamp)",
+            ExpressionAttributeNames={"#timestamp": "timestamp"},
+        )
+        return True
+    except db_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def query_items(limit=None, **query_kwargs):
+    # Walks LastEvaluatedKey so teams larger than one 1 MB page are complete,
+    # while only holding one page in memory. With a limit, every page asks
+    # DynamoDB for no more than the items still missing.
+    found = 0
+    while limit is None or found < limit:
+        if limit is not None:
+            query_kwargs["Limit"] = limit - found
+        response = db_table.query(**query_kwargs)
+        for item in response["Items"]:
+            found += 1
+            yield item
+        if "LastEvaluatedKey" not in response:
+            return
+        query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def batch_write_items(items, max_items_per_second=None, max_attempts=8):
+    # BatchWriteItem takes at most 25 items. Throttled writes come back as
+    # UnprocessedItems and are retried with exponential backoff and jitter.
+    items = list(items)
+    written = 0
+    started = time.time()
+    for start in range(0, len(items), 25):
+        request = {
+            DATABASE_TABLE: [
+                {"PutRequest": {"Item": item}} for item in items[start : start + 25]
+            ]
+        }
+        attempt = 0
+        while request:
+            if attempt >= max_attempts:
+                raise Exception(
+                    f"Could not write {len(request[DATABASE_TABLE])} items "
+                    f"after {attempt} attempts"
+                )
+            if attempt > 0:
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+            response = dynamodb.batch_write_item(RequestItems=request)
+            request = response.get("UnprocessedItems")
+            attempt += 1
+        written += len(items[start : start + 25])
+        if max_items_per_second is not None:
+            ahead = written / max_items_per_second - (time.time() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+    return written
+
+
+class BatchWriter:
+    # One long-lived thread writes items with batch_write_items while callers
+    # keep working. put() blocks once max_pending items are waiting, so memory
+    # stays bounded. A failed write adds its exception to the errors list that
+    # was passed with each item of that batch.
+    def __init__(self, max_pending=100):
+        self.items = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _run(self):
+        while True:
+            batch = [self.items.get()]
+            while len(batch) < 25:
+                try:
+                    batch.append(self.items.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                batch_write_items(item for item, _ in batch)
+            except Exception as e:
+                for _, errors in batch:
+                    errors.append(e)
+            for _ in batch:
+                self.items.task_done()
+
+    def put(self, item, errors):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        self.items.put((item, errors))
+
+    def flush(self):
+        # waits for everything put so far, also by other threads
+        self.items.join()
+
+
+background_writer = BatchWriter()
+
+
+def batch_get_items(keys, **kwargs):
+    # kwargs such as ProjectionExpression apply to every key
+    keys = list(keys)
+    for start in range(0, len(keys), 100):
+        request = {DATABASE_TABLE: {"Keys": keys[start : start + 100], **kwargs}}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            yield from response["Responses"].get(DATABASE_TABLE, [])
+            request = response.get("UnprocessedKeys")
+
+
+def _slack_callback_handler(callback_type, command, deferred=False):
     global SLACK_CALLBACK_HANDLERS
     if command in SLACK_CALLBACK_HANDLERS[callback_type]:
         raise Exception(f"{callback_type} {command} is already registered")
 
     def wrapper(handler):
         SLACK_CALLBACK_HANDLERS[callback_type][command] = handler
+        if deferred:
+            DEFERRED_CALLBACKS.add((callback_type, command))
         return handler
 
     return wrapper
 
 
-def slack_command(command):
-    return _slack_callback_handler("command", command)
+def slack_command(command, deferred=False):
+    # Deferred commands are acknowledged right away, their answer is posted to
+    # the response_url once the work queue ran them.
+    return _slack_callback_handler("command", command, deferred)
 
 
-def slack_block_action(action):
-    return _slack_callback_handler("block_actions", action)
+def slack_block_action(action, deferred=False):
+    return _slack_callback_handler("block_actions", action, deferred)
 
 
 def slack_view_submission(action):
     return _slack_callback_handler("view_submission", action)
 
 
+class LambdaQueue:
+    # Runs jobs in a second, asynchronous invocation of this Lambda function
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.client = boto3.client("lambda")
+
+    def put(self, job):
+        self.client.invoke(
+            FunctionName=self.function_name,
+            InvocationType="Event",
+            Payload=json.dumps({"deferred": job}).encode(),
+        )
+
+
+class LocalQueue:
+    # Keeps jobs in memory until run() is called, for running outside Lambda
+    def __init__(self):
+        self.jobs = []
+
+    def put(self, job):
+        self.jobs.append(job)
+
+    def run(self, handler):
+        while len(self.jobs) > 0:
+            handler(self.jobs.pop(0))
+
+
+if "AWS_LAMBDA_FUNCTION_NAME" in os.environ:
+    work_queue = LambdaQueue(os.environ["AWS_LAMBDA_FUNCTION_NAME"])
+else:
+    work_queue = LocalQueue()
+
+
+class TokenBucket:
+    # Hands out up to rate tokens per second with bursts of up to capacity,
+    # take() blocks until a token is available. Safe to share between threads.
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        # Nobody gets a token for the next seconds, used when the server says so
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def migration(name):
+    if name in MIGRATIONS:
+        raise Exception(f"migration {name} is already registered")
+
+    def wrapper(handler):
+        MIGRATIONS[name] = handler
+        return handler
+
+    return wrapper
+
+
 def extract_key_from_payload(callback_type, data):
     if callback_type == "block_actions":
         if "actions" not in data:
@@ -110,6 +407,88 @@ def validate_signature(event):
         raise Exception("Signature does not match, will not execute request")
 
 
+def _new_slack_session():
+    # Kept at module level, so warm invocations reuse the open TLS connections.
+    # Any call is retried when it could not connect. Gateway errors are only
+    # retried for GETs, a POST like chat.postMessage may have been acted on.
+    retries = Retry(
+        total=3,
+        read=0,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=2, pool_maxsize=SLACK_POOL_SIZE, max_retries=retries
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+slack_session = _new_slack_session()
+_slack_buckets = {}
+_slack_stats = collections.Counter()
+_slack_lock = threading.Lock()
+
+
+def _slack_bucket(method):
+    with _slack_lock:
+        if method not in _slack_buckets:
+            per_minute = SLACK_TIER_CALLS_PER_MINUTE[SLACK_METHOD_TIERS.get(method, 3)]
+            _slack_buckets[method] = TokenBucket(per_minute / 60, per_minute)
+        return _slack_buckets[method]
+
+
+def _count_slack_call(key):
+    with _slack_lock:
+        _slack_stats[key] += 1
+
+
+def slack_api_stats():
+    # Calls and throttled (HTTP 429) calls per method since the container started
+    with _slack_lock:
+        return dict(_slack_stats)
+
+
+def _slack_api(method, http_method="POST", **kwargs):
+    bucket = _slack_bucket(method)
+    for attempt in range(SLACK_MAX_ATTEMPTS):
+        bucket.take()
+        _count_slack_call(method)
+        r = slack_session.request(
+            http_method,
+            f"{SLACK_API_URL}/{method}",
+            headers=SLACK_HEADERS,
+            timeout=SLACK_TIMEOUT,
+            **kwargs,
+        )
+        if r.status_code != 429:
+            r.raise_for_status()
+            return r.json()
+        _count_slack_call(f"{method} throttled")
+        wait = int(r.headers.get("Retry-After", 1)) + random.uniform(0, 2 ** attempt)
+        print("slack throttled", method, "retrying in", round(wait, 1), "seconds")
+        bucket.pause(wait)
+    raise Exception(f"{method} is still throttled after {SLACK_MAX_ATTEMPTS} attempts")
+
+
+def respond(response_url, text, ephemeral=False):
+    # An ephemeral answer is only shown to the user who clicked or typed, and
+    # leaves the message the action came from as it was.
+    print("responding to", response_url)
+    payload = {
+        "response_type": "ephemeral" if ephemeral else "in_channel",
+        "text": text,
+    }
+    if ephemeral:
+        payload["replace_original"] = False
+    r = slack_session.post(response_url, json=payload, timeout=SLACK_TIMEOUT)
+    r.raise_for_status()
+
+
 def send_message(channel_id, blocks, text, post_at=None):
     payload = {
         "blocks": blocks,
@@ -118,112 +497,126 @@ def send_message(channel_id, blocks, text, post_at=None):
     }
     if post_at is None:
         print("sending message to", channel_id)
-        url = "https://slack.com/api/chat.postMessage"
+        method = "chat.postMessage"
     else:
         print("scheduling message to", channel_id, "at", post_at)
         payload["post_at"] = post_at
-        url = "https://slack.com/api/chat.scheduleMessage"
+        method = "chat.scheduleMessage"
 
-    r = requests.post(
-        url,
-        headers={
-            "Content-type": "application/json",
-            "Authorization": f"Bearer {BEARER_TOKEN}",
-        },
-        json=payload,
-    )
-    r.raise_for_status()
-    if not r.json()["ok"]:
-        if "error" in r.json():
-            raise Exception(r.json()["error"])
-        raise Exception(r.json()["response_metadata"]["messages"])
+    data = _slack_api(method, json=payload)
+    if not data["ok"]:
+        if "error" in data:
+            raise Exception(data["error"])
+        raise Exception(data["response_metadata"]["messages"])
     if post_at is None:
-        return r.json()["ts"]
+        return data["ts"]
     else:
-        return r.json()["scheduled_message_id"]
+        return data["scheduled_message_id"]
 
 
 def delete_scheduled_message(channel_id, msg_id):
     print("deleting scheduled message", channel_id, msg_id)
-    r = requests.post(
-        "https://slack.com/api/chat.deleteScheduledMessage",
-        headers={
-            "Content-type": "application/json",
-            "Authorization": f"Bearer {BEARER_TOKEN}",
-        },
+    data = _slack_api(
+        "chat.deleteScheduledMessage",
         json={
             "channel": channel_id,
             "scheduled_message_id": msg_id,
         },
     )
-    if not r.json()["ok"]:
-        raise Exception(r.json()["response_metadata"]["messages"])
-    r.raise_for_status()
+    if not data["ok"]:
+        raise Exception(data["response_metadata"]["messages"])
 
 
 def update_message(blocks, channel_id, ts_id):
     print("updating message to", channel_id)
-    r = requests.post(
-        "https://slack.com/api/chat.update",
-        headers={
-            "Content-type": "application/json",
-            "Authorization": f"Bearer {BEARER_TOKEN}",
-        },
+    data = _slack_api(
+        "chat.update",
         json={
             "channel": channel_id,
             "blocks": blocks,
             "ts": ts_id,
         },
     )
-    if not r.json()["ok"]:
-        raise Exception(r.json()["response_metadata"]["messages"])
-    r.raise_for_status()
+    if not data["ok"]:
+        raise Exception(data["response_metadata"]["messages"])
 
 
 def open_view(trigger_id, blocks, text, submit_text, callback_id):
+    # Without submit_text the modal only shows information and can be closed
     print("opening view", trigger_id, callback_id)
-    r = requests.post(
-        "https://slack.com/api/views.open",
-        headers={
-            "Content-type": "application/json",
-            "Authorization": f"Bearer {BEARER_TOKEN}",
-        },
+    view = {
+        "type": "modal",
+        "callback_id": callback_id,
+        "title": {"type": "plain_text", "text": text},
+        "blocks": blocks,
+    }
+    if submit_text is not None:
+        view["submit"] = {
+            "type": "plain_text",
+            "text": submit_text,
+        }
+    data = _slack_api(
+        "views.open",
         json={
             "trigger_id": trigger_id,
-            "view": {
-                "type": "modal",
-                "callback_id": callback_id,
-                "title": {"type": "plain_text", "text": text},
-                "blocks": blocks,
-                "submit": {
-                    "type": "plain_text",
-                    "text": submit_text,
-                },
-            },
+            "view": view,
         },
     )
-    if not r.json()["ok"]:
-        raise Exception(r.json()["response_metadata"]["messages"])
-    r.raise_for_status()
+    if not data["ok"]:
+        raise Exception(data["response_metadata"]["messages"])
 
 
 def update_view(view, view_id):
     print("updating view", view_id)
-    r = requests.post(
-        "https://slack.com/api/views.update",
-        headers={
-            "Content-type": "application/json",
-            "Authorization": f"Bearer {BEARER_TOKEN}",
-        },
+    data = _slack_api(
+        "views.update",
         json={
             "view": view,
             "view_id": view_id,
         },
     )
-    if not r.json()["ok"]:
-        raise Exception(r.json()["response_metadata"]["messages"])
+    if not data["ok"]:
+        raise Exception(data["response_metadata"]["messages"])
+
+
+def upload_file(channel_id, path, filename, title, comment):
+    # files.upload is retired, the external upload flow streams the file from
+    # disk so its size does not count against the Lambda memory.
+    print("uploading file", filename, "to", channel_id)
+    upload = _slack_api(
+        "files.getUploadURLExternal",
+        http_method="GET",
+        params={"filename": filename, "length": os.path.getsize(path)},
+    )
+    if not upload["ok"]:
+        raise Exception(upload["error"])
+
+    with open(path, "rb") as f:
+        r = slack_session.post(upload["upload_url"], data=f, timeout=SLACK_TIMEOUT)
     r.raise_for_status()
 
+    data = _slack_api(
+        "files.completeUploadExternal",
+        json={
+            "files": [{"id": upload["file_id"], "title": title}],
+            "channel_id": channel_id,
+            "initial_comment": comment,
+        },
+    )
+    if not data["ok"]:
+        raise Exception(data["error"])
+
+
+def get_channel_member_count(channel_id):
+    data = _slack_api(
+        "conversations.info",
+        http_method="GET",
+        params={"channel": channel_id, "include_num_members": "true"},
+    )
+    if not data["ok"]:
+        raise Exception(data["error"])
+    return data["channel"]["num_members"]
+
 
 def get_all_scheduled_posts(channel):
     past_cursors = set()
@@ -232,16 +625,9 @@ def get_all_scheduled_posts(channel):
     }
     while True:
         print("getting", payload)
-        r = requests.get(
-            "https://slack.com/api/chat.scheduledMessages.list",
-            headers={
-                "Content-type": "application/json",
-                "Authorization": f"Bearer {BEARER_TOKEN}",
-            },
-            json=payload,
+        data = _slack_api(
+            "chat.scheduledMessages.list", http_method="GET", json=payload
         )
-        r.raise_for_status()
-        data = r.json()
         yield from data["scheduled_messages"]
         del data["scheduled_messages"]
         print(data)